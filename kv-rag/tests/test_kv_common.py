@@ -0,0 +1,30 @@
+import os
+import sys
+
+import orjson
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "utils"))
+
+from kv_common import load_rules  # noqa: E402
+
+
+def _write_rules(tmp_path, data):
+    path = tmp_path / "rules.json"
+    path.write_bytes(orjson.dumps(data))
+    return str(path)
+
+
+def test_load_rules_indexes_terms_case_insensitively(tmp_path):
+    path = _write_rules(tmp_path, {
+        "V.1": {"definition": "...", "terms": {"Firewall": "V.1"}},
+        "V.2": {"definition": "...", "terms": {"firewall": "V.2"}},
+    })
+    _, term_index = load_rules(path, os.path.getmtime(path))
+    assert term_index == {"firewall": ["V.1", "V.2"]}
+
+
+def test_load_rules_names_a_string_encoded_entry(tmp_path):
+    path = _write_rules(tmp_path, {"V.1": {"definition": "..."}, "V.2": '{"definition": "..."}'})
+    with pytest.raises(TypeError, match="'V.2'"):
+        load_rules(path, os.path.getmtime(path))
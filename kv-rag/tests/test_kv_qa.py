@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "utils"))
+
+from kv_qa import parse_question  # noqa: E402
+
+_PREAMBLE = ("We are a student engineering team designing a vehicle for the FSAE competition. "
+             "Attached is the FSAE rules document. ")
+
+
+@pytest.mark.parametrize("question, rule", [
+    (_PREAMBLE + "What does rule V.1 state exactly? Answer with only the text of the rule and no other words.", "V.1"),
+    (_PREAMBLE + "What does rule EV.5.1.3 state exactly? Answer with only the text of the rule and no other words.",
+     "EV.5.1.3"),
+    (_PREAMBLE + "What does rule `IN.9.2` state exactly?", "IN.9.2"),
+    ("What does rule T.7.1.4b state exactly?", "T.7.1.4b"),
+    ("Quote rule AA.1.2.", "AA.1.2"),
+])
+def test_rule_questions_are_parsed_without_the_llm(question, rule):
+    assert parse_question(question) == {"key_to_extract": rule, "information_to_extract": "definition"}
+
+
+@pytest.mark.parametrize("question", [
+    "What does rule T.7.1.4(b) state exactly?",
+    "What does rule T.7.1.4bc state exactly?",
+    "What does rule F.3.2_a state exactly?",
+    "What does the first rule of section V say?",
+])
+def test_partially_matched_rule_questions_fall_back_to_the_llm(question):
+    assert parse_question(question) is None
+
+
+def test_term_questions_list_every_alternative():
+    question = (_PREAMBLE + "Please list all rules relevant to `Aerodynamic/Aerodynamics`. "
+                "Answer with only the rule numbers (i.e.: AA.1.1.1) separated by commas and no other words.")
+    assert parse_question(question) == {"key_to_extract": ["Aerodynamic", "Aerodynamics"],
+                                        "information_to_extract": "rule_numbers"}
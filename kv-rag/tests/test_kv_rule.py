@@ -0,0 +1,34 @@
+import os
+import sys
+
+import orjson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "utils"))
+
+from kv_common import REASONING_OUTPUT_TOKENS  # noqa: E402
+from kv_rule import (_batch_for_custom_id, _load_partial_results, _max_output_tokens, _prompt_hash,  # noqa: E402
+                     _split_batch_results)
+
+
+def test_split_batch_results_keeps_only_the_requested_pages():
+    results = _split_batch_results({"16": {"V.1": {}}, "99": {"X.1": {}}}, ["16", "17"])
+    assert results == {"16": {"V.1": {}}}
+
+
+def test_small_batch_cap_includes_the_reasoning_allowance():
+    assert _max_output_tokens([("16", "V.1 Wheelbase")]) > REASONING_OUTPUT_TOKENS
+
+
+def test_batch_for_custom_id_rejects_unknown_ids():
+    batches = [[("16", "...")], [("17", "...")]]
+    assert _batch_for_custom_id(batches, "pages-1") == [("17", "...")]
+    for custom_id in ("pages-2", "pages-x", "rules-0", None):
+        assert _batch_for_custom_id(batches, custom_id) is None
+
+
+def test_load_partial_results_drops_pages_of_another_prompt(tmp_path):
+    path = tmp_path / "extracted_rules.json.partial.jsonl"
+    path.write_bytes(orjson.dumps({"prompt": _prompt_hash("current"), "results": {"16": {"V.1": {}}}}) + b"\n"
+                     + orjson.dumps({"prompt": _prompt_hash("previous"), "results": {"17": {"V.2": {}}}}) + b"\n"
+                     + b'{"prompt": "')
+    assert _load_partial_results(str(path), "current") == {"16": {"V.1": {}}}
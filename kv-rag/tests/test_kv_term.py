@@ -0,0 +1,98 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "utils"))
+
+import kv_term  # noqa: E402
+from kv_common import REASONING_OUTPUT_TOKENS  # noqa: E402
+from kv_term import (_batch_model_options, _load_finished_rules, _request_kind, _split_batch_results,  # noqa: E402
+                     invoke_llm)
+
+
+@pytest.mark.parametrize("definition", [
+    "The brake light must illuminate within 5 seconds",
+    "The shutdown must complete within 30 sec",
+    "Charging must stop after 2 minutes",
+    "Bolts must be torqued to 10 Nm",
+    "The accumulator must not exceed 6 kWh",
+    "The resistor must be at least 3 kOhm",
+    "The fuse must be rated for 2 amps",
+    "The tank must withstand 20 psi",
+    "The vehicle must weigh less than 300 lb",
+    "The hoop must clear the helmet by 8.1 in",
+    "Minimum wall thickness 1.2 mm",
+])
+def test_definitions_with_a_measurement_get_details(definition):
+    assert _request_kind(definition) == "details"
+
+
+def test_definitions_without_digits_get_terms_only():
+    assert _request_kind("The Firewall must separate the driver from the Accumulator") == "terms"
+
+
+@pytest.mark.parametrize("definition", ["", "  ", "See IN.9.2", "see EV.5.1.3."])
+def test_empty_or_cross_reference_definitions_need_no_request(definition):
+    assert _request_kind(definition) is None
+
+
+def test_small_batch_cap_includes_the_reasoning_allowance():
+    batch = [("1", "1.0", {"definition": "Length is 5 mm"})]
+    assert _batch_model_options(batch)["max_output_tokens"] > REASONING_OUTPUT_TOKENS
+
+
+class _TruncatingClient:
+    """Stub client whose responses are cut off until the cap reaches `enough_tokens`."""
+
+    def __init__(self, enough_tokens):
+        self.enough_tokens = enough_tokens
+        self.caps = []
+        self.responses = self
+
+    async def create(self, **options):
+        self.caps.append(options["max_output_tokens"])
+        if options["max_output_tokens"] < self.enough_tokens:
+            return SimpleNamespace(status="incomplete", incomplete_details=SimpleNamespace(reason="max_output_tokens"),
+                                   output_text='{"1.0": {"technical_')
+        return SimpleNamespace(status="completed", incomplete_details=None, output_text='{"1.0": {"technical_terms": []}}')
+
+
+def test_invoke_llm_doubles_the_cap_of_a_truncated_response(monkeypatch):
+    monkeypatch.setattr(kv_term, "_llm_cache", {})
+    client = _TruncatingClient(enough_tokens=12000)
+    results = asyncio.run(invoke_llm(client, asyncio.Semaphore(1), "===RULE 1.0===\nText", "prompt",
+                                     max_output_tokens=5000))
+    assert results == {"1.0": {"technical_terms": []}}
+    assert client.caps == [5000, 10000, 20000]
+
+
+_BATCH = [("1", "1.0", {"definition": "Length is 5 mm"}), ("1", "1.1", {"definition": "Width is 2 mm"})]
+
+
+def test_split_batch_results_marks_every_rule_of_a_failed_request():
+    assert _split_batch_results(None, _BATCH) == {("1", "1.0"): None, ("1", "1.1"): None}
+
+
+def test_split_batch_results_leaves_missing_rules_empty():
+    results = _split_batch_results({"1.0": {"technical_terms": ["Length"]}, "9.9": {}}, _BATCH)
+    assert results == {("1", "1.0"): {"technical_terms": ["Length"]}, ("1", "1.1"): {}}
+
+
+def test_load_finished_rules_cuts_off_an_incomplete_last_line(tmp_path):
+    path = tmp_path / "processed_rules.jsonl"
+    complete = (b'{"page": "1", "rule": "1.0", "details": {"terms": []}}\n'
+                b'not json\n'
+                b'{"page": "1", "rule": "1.1", "details": {}}\n')
+    path.write_bytes(complete + b'{"page": "1", "rule": "1.2", "det')
+    assert _load_finished_rules(str(path)) == {("1", "1.0"): True, ("1", "1.1"): False}
+    assert path.read_bytes() == complete
+
+
+def test_load_finished_rules_counts_a_retried_rule_once_it_has_terms(tmp_path):
+    path = tmp_path / "processed_rules.jsonl"
+    path.write_bytes(b'{"page": "1", "rule": "1.0", "details": {"terms": []}}\n'
+                     b'{"page": "1", "rule": "1.0", "details": {}}\n')
+    assert _load_finished_rules(str(path)) == {("1", "1.0"): True}
@@ -1,77 +1,110 @@
-from PyPDF2 import PdfReader
 import re
 import csv
-import pdfplumber
-import json
+import numpy as np
+import pymupdf
+import os
+from concurrent.futures import ProcessPoolExecutor
+from kv_common import write_json
+
+
+# Regex pattern to match multiple formats of rule numbers (e.g. V.1.2, EV.6, IN)
+_RULE_NUMBER_RE = re.compile(r'\b([A-Z]+(?:\.\d+)+|[A-Z]+\.\d+|[A-Z]{1,2})\b')
 
 
 # Function to remove rule numbers from the text
 def remove_rule_numbers(text):
-    # Regex pattern to match multiple formats of rule numbers
-    rule_number_pattern = r'\b([A-Z]+(?:.\d+)+|[A-Z]+.\d+|[A-Z]{1,2})\b'
     # Remove all matches of the rule numbers
-    cleaned_text = re.sub(rule_number_pattern, '', text)
-    return cleaned_text
+    return _RULE_NUMBER_RE.sub('', text)
 
 
-def extract_text_with_pdfplumber(pdf_path, output_txt_path, header_footer_margin=50):
+def _extract_page_range(pdf_path, start_page, end_page, header_footer_margin=50):
     """
-    Extracts text from a PDF using pdfplumber, while preserving bullets, indentation,
-    and excluding headers/footers.
+    Extracts the text lines of a contiguous range of pages. Runs inside a worker
+    process, so it opens its own handle on the PDF.
 
     Args:
         pdf_path (str): Path to the PDF file.
-        output_txt_path (str): Path to save the extracted text.
+        start_page (int): Index of the first page to extract (0-based, inclusive).
+        end_page (int): Index of the last page to extract (0-based, exclusive).
         header_footer_margin (int): Margin in points (approx. pixels) to exclude as header/footer.
+
+    Returns:
+        list: A list of (page_index, lines) tuples, one per page in the range.
     """
-    def is_in_main_body(y, page_height):
-        """Check if y-coordinate is outside header/footer margins."""
-        return header_footer_margin < y < page_height - header_footer_margin
+    pages = []
+    with pymupdf.open(pdf_path) as pdf:
+        for page_num in range(start_page, end_page):
+            page = pdf[page_num]
+            page_height = page.rect.height
 
+            # Extract all text with positional information as
+            # (x0, y0, x1, y1, word, block_no, line_no, word_no) tuples, sorted top-to-bottom
+            words_with_positions = page.get_text("words", sort=True)
 
-    with pdfplumber.open(pdf_path) as pdf, open(output_txt_path, "w", encoding="utf-8") as output_file:
-        for page_num, page in enumerate(pdf.pages):
-            output_file.write(f"--- Page {page_num + 1} ---\n")  # Separate pages for clarity
-            page_height = page.height
+            # Skip words in the header or footer margin
+            tops = np.fromiter((word[1] for word in words_with_positions), dtype=np.float64,
+                               count=len(words_with_positions))
+            in_main_body = (tops > header_footer_margin) & (tops < page_height - header_footer_margin)
+            kept = np.flatnonzero(in_main_body)
 
-            # Extract all text with positional information
-            words_with_positions = page.extract_words()
+            # Start a new line wherever the vertical position jumps by the same-line tolerance or more
+            breaks = np.flatnonzero(np.abs(np.diff(tops[kept])) >= 5) + 1
+            grouped_lines = [
+                [words_with_positions[i] for i in group]
+                for group in np.split(kept, breaks) if group.size
+            ]
 
-            # Initialize variables to group text intelligently
-            grouped_lines = []
-            current_line = []
+            # Process grouped lines into properly formatted text (bullets such as "•" or "-" are kept as-is)
+            lines = [" ".join(word[4] for word in line).strip() for line in grouped_lines]
 
-            for word in words_with_positions:
-                top = word['top']
-                text = word['text']
+            pages.append((page_num, lines))
 
-                # Skip words in the header or footer margin
-                if not is_in_main_body(top, page_height):
-                    continue
+    return pages
 
-                # Keep grouping words into the same line based on their vertical positions
-                if not current_line or abs(top - current_line[-1]['top']) < 5:  # Same line tolerance
-                    current_line.append(word)
-                else:
-                    # Finalize the previous line
-                    grouped_lines.append(current_line)
-                    current_line = [word]  # Start a new line
 
-            # Add the last line if there's any
-            if current_line:
-                grouped_lines.append(current_line)
+def extract_text_with_pymupdf(pdf_path, output_txt_path=None, header_footer_margin=50, max_workers=None):
+    """
+    Extracts text from a PDF using PyMuPDF, while preserving bullets, indentation,
+    and excluding headers/footers. Pages are split into contiguous ranges that are
+    extracted in parallel worker processes.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+        output_txt_path (str, optional): Path to also save the extracted text. Skipped if None.
+        header_footer_margin (int): Margin in points (approx. pixels) to exclude as header/footer.
+        max_workers (int, optional): Number of worker processes. Defaults to the CPU count.
 
-            # Process grouped lines into properly formatted text
-            for line in grouped_lines:
-                line_text = " ".join(word['text'] for word in line)
+    Returns:
+        dict: A dictionary mapping page numbers (as strings, 1-based) to the page text.
+    """
+    with pymupdf.open(pdf_path) as pdf:
+        n_pages = pdf.page_count
+
+    # Split the pages into one contiguous range per worker
+    max_workers = min(max_workers or os.cpu_count() or 1, max(n_pages, 1))
+    chunk_size = max(-(-n_pages // max_workers), 1)  # Ceiling division
+    page_ranges = [(start, min(start + chunk_size, n_pages)) for start in range(0, n_pages, chunk_size)]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_extract_page_range, pdf_path, start, end, header_footer_margin)
+            for start, end in page_ranges
+        ]
+        # Futures are collected in submission order, so pages stay in document order
+        results = [page for future in futures for page in future.result()]
+
+    page_content_dict = {str(page_num + 1): "\n".join(lines).strip() for page_num, lines in results}
+
+    if output_txt_path is not None:
+        with open(output_txt_path, "w", encoding="utf-8") as output_file:
+            for page_num, lines in results:
+                output_file.write(f"--- Page {page_num + 1} ---\n")  # Separate pages for clarity
+                for line in lines:
+                    output_file.write(line + "\n")
+        print(f"Extracted text saved to: {output_txt_path}")
 
-                # Preserve bullets or indentations
-                if line_text.strip().startswith(("•", "-")):
-                    output_file.write(line_text.strip() + "\n")
-                else:
-                    output_file.write(line_text.strip() + "\n")  # Regular text
+    return page_content_dict
 
-    print(f"Extracted text saved to: {output_txt_path}")
 
 def split_text_by_page(text_file, output_json):
     """
@@ -82,40 +115,42 @@ def split_text_by_page(text_file, output_json):
         output_json (str): Path to save the dictionary as a JSON file.
     """
     page_content_dict = {}
+    page_marker = "--- Page "
 
+    # Stream the file line by line, flushing each page when the next marker (e.g., "--- Page X ---") is reached
+    current_page = None
+    buffer = []
     with open(text_file, "r", encoding="utf-8") as file:
-        text = file.read()
-
-    # Split text by the recognized page markers (e.g., "--- Page X ---")
-    pages = text.split("--- Page ")
-
-    for page in pages:
-        if page.strip():  # Skip empty splits
-            parts = page.split("---", 1)  # Split into page number and page content
-            if len(parts) == 2:
-                page_number, content = parts
-                page_number = page_number.strip()  # Clean up "Page X"
-                page_content_dict[page_number] = content.strip()
-            elif len(parts) == 1: # Edge case for 'Page 1'
-                page,pagecontent = parts
-                page_content_dict[page] = pagecontent.strip()
+        for line in file:
+            if line.startswith(page_marker):
+                if current_page is not None:
+                    page_content_dict[current_page] = "".join(buffer).strip()
+                current_page = line[len(page_marker):].strip().rstrip("-").strip()  # Clean up "Page X"
+                buffer = []
+            elif current_page is not None:
+                buffer.append(line)
+
+    # Add the last page if there's any
+    if current_page is not None:
+        page_content_dict[current_page] = "".join(buffer).strip()
 
     # Save the dictionary to a JSON file
-    with open(output_json, "w", encoding="utf-8") as json_file:
-        json.dump(page_content_dict, json_file, indent=4)
-        print(f"Text split by page and saved to {output_json}")
+    write_json(output_json, page_content_dict)
+    print(f"Text split by page and saved to {output_json}")
 
     return page_content_dict
 
 
-# Path to the PDF file
-pdf_path = "../../dataset/docs/FSAE_Rules_2024_V1.pdf" 
-output_txt_path  = '../files/cln_rules.txt'
-text_json = '../files/cln_rules.json'
-# Define header and footer dimensions
-header_height = 50  # Points (1 inch = 72 points)
-footer_height = 50  # Points
+if __name__ == "__main__":
+    # Guarded so that worker processes can import this module without re-running the script
+    # Path to the PDF file
+    pdf_path = "../../dataset/docs/FSAE_Rules_2024_V1.pdf" 
+    text_json = '../files/cln_rules.json'
+    # Define header and footer dimensions
+    header_height = 50  # Points (1 inch = 72 points)
+    footer_height = 50  # Points
 
-# Extract text from the PDF
-cln_text = extract_text_with_pdfplumber(pdf_path, output_txt_path, header_footer_margin=50)
-page_content_dict = split_text_by_page(output_txt_path, text_json)
\ No newline at end of file
+    # Extract text from the PDF straight into a page dictionary and save it as JSON
+    page_content_dict = extract_text_with_pymupdf(pdf_path, header_footer_margin=50)
+    write_json(text_json, page_content_dict)
+    print(f"Text split by page and saved to {text_json}")
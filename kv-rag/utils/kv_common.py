@@ -0,0 +1,152 @@
+import os
+import sys
+import mmap
+import atexit
+import pickle
+import logging
+import importlib.util
+import orjson
+import httpx
+from functools import lru_cache
+
+
+# Helpers shared by the kv-rag scripts, which import them from this module when run from this folder
+log = logging.getLogger(__name__)
+
+# Connection pool for the OpenAI clients: HTTP/2 with keep-alive, so bursts of requests reuse connections.
+# httpx needs the optional h2 package (httpx[http2]) for HTTP/2, so the clients fall back to HTTP/1.1 without it
+HTTP2 = importlib.util.find_spec("h2") is not None
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+HTTP_TIMEOUT = httpx.Timeout(60.0)
+
+# The gpt-5 models count their reasoning tokens against `max_output_tokens`, so every request's cap gets this
+# allowance on top of its expected output. A response cut off at the cap is retried with the cap doubled,
+# up to the models' output limit
+REASONING_OUTPUT_TOKENS = 4000
+OUTPUT_TOKENS_LIMIT = 128000
+
+
+def read_json(path):
+    """Reads a JSON file with orjson, memory-mapping it so the bytes are parsed without an extra copy."""
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return orjson.loads(b"")  # Raises the usual decode error; empty files cannot be mapped
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return orjson.loads(memoryview(mapped))
+
+
+def write_json(path, data):
+    """Writes data to a JSON file with orjson, indented for readability."""
+    with open(path, 'wb') as file:
+        file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+
+def read_records(path):
+    """
+    Streams the rule records of a JSONL file written by kv_term.extract_details, one
+    {"page": ..., "rule": ..., "details": {...}} object per line.
+
+    Args:
+        path (str): Path to the JSONL file.
+
+    Yields:
+        tuple: (page, rule, details) for each complete line.
+    """
+    with open(path, 'rb') as file:
+        for line in file:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                log.warning("Skipping an incomplete line in %s", path)
+                continue
+            yield record["page"], record["rule"], record["details"]
+
+
+def persistent_cache(path):
+    """
+    Loads a dictionary cache pickled at `path`, or starts an empty one, and saves it back there when the
+    interpreter exits, so that reruns reuse the answers of earlier runs.
+
+    Args:
+        path (str): Path of the pickle file.
+
+    Returns:
+        dict: The cache, to be filled in place.
+    """
+    try:
+        with open(path, 'rb') as file:
+            cache = pickle.load(file)
+    except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+        cache = {}
+    atexit.register(_save_cache, path, cache)
+    return cache
+
+
+def _save_cache(path, cache):
+    """Pickles a non-empty cache to `path`."""
+    if cache:
+        with open(path, 'wb') as file:
+            pickle.dump(cache, file)
+
+
+def is_truncated(response):
+    """Whether the response stopped early because it reached its `max_output_tokens` cap."""
+    incomplete_details = getattr(response, "incomplete_details", None)
+    return (getattr(response, "status", None) == "incomplete"
+            and getattr(incomplete_details, "reason", None) == "max_output_tokens")
+
+
+def response_output_text(body):
+    """
+    Concatenates the text output of a raw Responses API body, as returned by the Batch API.
+
+    Args:
+        body (dict): The response body.
+
+    Returns:
+        str: The text produced by the model.
+    """
+    return "".join(
+        content.get("text", "")
+        for item in body.get("output", []) if item.get("type") == "message"
+        for content in item.get("content", []) if content.get("type") == "output_text"
+    )
+
+
+@lru_cache(maxsize=8)
+def load_rules(path, mtime):
+    """
+    Loads and caches a rules JSON file together with an inverted term index.
+    The modification time is part of the cache key so that a rewritten file is parsed again.
+
+    The writers (kv_termArrange.flatten_json/extract_terms) only emit decoded entries, so a string-encoded
+    entry means the file is stale and is rejected instead of being re-parsed on every query.
+
+    Args:
+        path (str): Path to the JSON file.
+        mtime (float): Modification time of the file, used only as a cache key.
+
+    Returns:
+        tuple: (data, term_index) where data is the parsed JSON content and
+               term_index maps each lower-cased term to the list of its rule numbers.
+
+    Raises:
+        TypeError: If an entry of the file is not a JSON object.
+    """
+    data = read_json(path)
+
+    term_index = {}
+    for key, value in data.items():
+        if not isinstance(value, dict):
+            raise TypeError(f"Entry {key!r} in {path} is a {type(value).__name__}, not a decoded JSON object")
+        terms = value.get("terms", {})
+        if not isinstance(terms, dict):  # Term entries store the raw term name instead
+            continue
+        for term, rule in terms.items():
+            term_key = sys.intern(term.lower())
+            rule_numbers = term_index.get(term_key)
+            if rule_numbers is None:
+                rule_numbers = term_index[term_key] = []
+            rule_numbers.append(rule)
+
+    return data, term_index
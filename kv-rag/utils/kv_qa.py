@@ -1,20 +1,41 @@
 from email.mime import text
 import os
+import re
 import json
+import asyncio
 import sys
 from xml.parsers.expat import model
 from dotenv import load_dotenv
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI
 from collections import defaultdict
 import pandas as pd
+from kv_common import HTTP2, HTTP_LIMITS, HTTP_TIMEOUT, load_rules, persistent_cache
 
 
-# Load .env from the parent directory (adjust path if needed)
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '../../.env'))
+# Load .env from the parent directory (adjust path if needed), unless the key is already in the environment
+if "OPENAI_API_KEY" not in os.environ:
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '../../.env'))
 #api_key = os.getenv("OPENAI_API_KEY")    
 
 output_file_with_terms = '../files/processed_rules_with_terms.json'
 
+# Patterns for the two benchmark question types, e.g. "What does rule V.1 state exactly?"
+# and "List all rules relevant to `Aerodynamic/Aerodynamics`." The rule number must be followed by
+# whitespace, punctuation or the end, so that a sub-item such as T.7.1.4b is not cut back to T.7.1 and a
+# number followed by anything else (e.g. "T.7.1.4(b)") is left for the language model to parse
+_RULE_QUESTION_RE = re.compile(r'\b(?i:rule)\s+`?([A-Z]+(?:\.\d+)+[a-z]?)`?(?=[\s?!,;:]|\.(?!\w)|$)')
+_TERM_QUESTION_RE = re.compile(r'(?i:relevant\s+to)\s+`([^`]+)`')
+
+# Parsed questions from the language model, keyed by (model, normalized question) and kept between runs
+question_cache_file = '../files/retrieve_context.cache.pkl'
+_question_cache = persistent_cache(question_cache_file)
+
+
+def _is_question_parse(answer):
+    """Whether a model answer is a usable question parse, so that failed requests are never cached."""
+    return isinstance(answer, dict) and "key_to_extract" in answer and "information_to_extract" in answer
+
 
 def extract_information(input_file, key_to_extract, information_to_extract):
     """
@@ -30,9 +51,8 @@ def extract_information(input_file, key_to_extract, information_to_extract):
     Returns:
         str or list: The extracted information, or a message if the key is not found or invalid.
     """
-    # Step 1: Load the JSON file
-    with open(input_file, 'r') as file:
-        data = json.load(file)
+    # Step 1: Load the JSON file (cached until the file changes on disk)
+    data, term_index = load_rules(input_file, os.path.getmtime(input_file))
 
     # Step 2: Extract definition for a rule number
     if information_to_extract == "definition":
@@ -49,27 +69,8 @@ def extract_information(input_file, key_to_extract, information_to_extract):
         
     # Step 3: Extract rule numbers for a technical term
     elif information_to_extract == "rule_numbers":
-        # Check if the key_to_extract matches any term across the JSON
-        rule_numbers = []
-        for key, value in data.items():
-            if isinstance(value, str):
-                try:
-                    value = json.loads(value)
-                except json.JSONDecodeError:
-                    print(f"Warning: Could not decode data for key {key}")
-                    continue
-                print(f'Processing key: {key}, and value: {type(value)}')
-            terms = value.get("terms", {})
-            if isinstance(terms, str):
-                try:
-                    terms = json.loads(terms)
-                except json.JSONDecodeError:
-                    print(f"Warning: Could not decode terms for key {key}")
-                    continue
-            print(f'Processing key: {key}, and terms: {type(terms)}')
-            for term, rule in terms.items():
-                if term.lower() == key_to_extract.lower():  # Case-insensitive matching
-                    rule_numbers.append(rule)
+        # Look the term up in the precomputed index (case-insensitive matching)
+        rule_numbers = list(term_index.get(key_to_extract.lower(), []))
         return rule_numbers if rule_numbers else f"Technical term '{key_to_extract}' not found in the JSON file."
 
     # Step 4: Handle invalid information_to_extract values
@@ -77,19 +78,11 @@ def extract_information(input_file, key_to_extract, information_to_extract):
         return f"Invalid information_to_extract value: {information_to_extract}. Use 'definition' or 'rule_numbers'."
 
 
-
-key1 = 'V.1.2'  # Example key to extract
-key2 = "rollover stability"
-
-result1 = extract_information(output_file_with_terms, key1, "definition")
-print(result1)
-result2 = extract_information(output_file_with_terms, key2, "rule_numbers")
-print(result2)
-
-def invoke_llm(model, text, prompt):
+async def invoke_llm(client, model, text, prompt):
     """
     Find technical terms in the extracted definitions.
     Args:
+        client (AsyncOpenAI): The OpenAI client, shared by all requests of the run.
         extracted_definitions (dict): The extracted definitions dictionary.
     Returns:
         dict: A dictionary containing the found technical terms.
@@ -98,8 +91,6 @@ def invoke_llm(model, text, prompt):
     text = text.strip()
     #print(context)
 
-    # Initialize the OpenAI client (API key is automatically picked up from OPENAI_API_KEY environment variable)
-    client = OpenAI()
     results = {}
      # Define default prompt if none is provided
     if prompt is None:
@@ -114,7 +105,7 @@ def invoke_llm(model, text, prompt):
 
     # Create a chat completion
     try:
-        response = client.responses.create(
+        response = await client.responses.create(
             model=model,  # Specify the model to use
             input=prompt + "\n\n" + text,  # Combine prompt and context
         )
@@ -151,19 +142,45 @@ def read_csv_to_dataframe_with_filename(file_path):
         # Read the CSV file into a pandas DataFrame
         df = pd.read_csv(file_path)
         # Extract the file name from the file_path
-        file_name = file_path.split('/')[-1]  # Works for both Windows and Unix-style paths
+        file_name = os.path.basename(file_path)
         print(f'extracted file name: {file_name}')
         return df, file_name
     except FileNotFoundError:
-        file_name = file_path.split('/')[-1]
+        file_name = os.path.basename(file_path)
         return f"Error: File not found at the specified path '{file_path}'.", file_name
 
 
-def retrieve_context(model, question):
+def parse_question(question):
     """
-    Retrieves context relevant to the provided question from the language model.
+    Parses a question into the lookup it asks for without calling the language model.
 
     Args:
+        question (str): The question to parse.
+
+    Returns:
+        dict or None: `{"key_to_extract": ..., "information_to_extract": ...}`, or None if the
+                      question does not match a known pattern.
+    """
+    match = _RULE_QUESTION_RE.search(question)
+    if match:
+        return {"key_to_extract": match.group(1), "information_to_extract": "definition"}
+
+    match = _TERM_QUESTION_RE.search(question)
+    if match:
+        terms = [term.strip() for term in match.group(1).split("/") if term.strip()]
+        return {"key_to_extract": terms, "information_to_extract": "rule_numbers"}
+
+    return None
+
+
+async def retrieve_context(client, model, question):
+    """
+    Retrieves context relevant to the provided question. The question is parsed locally
+    when it matches a known pattern; the language model is only asked otherwise, and its
+    parse is cached by question text.
+
+    Args:
+        client (AsyncOpenAI): The OpenAI client, shared by all requests of the run.
         question (str): The question for which context needs to be retrieved.
         model (object): The LLM (Language Model) instance that supports generating context.
 
@@ -203,83 +220,147 @@ def retrieve_context(model, question):
     Expected Output 2:
     `{"key_to_extract": ["Aerodynamic", "Aerodynamics"], "information_to_extract": "rule_number"}`
     """
-    answer = invoke_llm(model, question, prompt)
-    if isinstance(answer, str):
-        try:
-            answer = json.loads(answer)
-        except json.JSONDecodeError:
-            print(f"Warning: Could not decode terms for {answer}")
+    answer = parse_question(question)
+    cache_key = (str(model), question.strip().lower())
+    # Entries without both keys were cached by an earlier run from a failed request, and are asked again
+    if answer is None and _is_question_parse(_question_cache.get(cache_key)):
+        answer = _question_cache[cache_key]
+    elif answer is None:
+        answer = await invoke_llm(client, model, question, prompt)
+        if isinstance(answer, str):
+            try:
+                answer = json.loads(answer)
+            except json.JSONDecodeError:
+                print(f"Warning: Could not decode terms for {answer}")
+        if _is_question_parse(answer):
+            _question_cache[cache_key] = answer
             
     print(f'answer is {answer}')
     key_to_extract = answer.get("key_to_extract")
     information_to_extract = answer.get("information_to_extract")
     print(f'output_file_with_terms is {output_file_with_terms}')
     print(f'key_to_extract is {key_to_extract}, information_to_extract is {information_to_extract}')
-    context = extract_information(output_file_with_terms, str(key_to_extract), str(information_to_extract))
+    if isinstance(key_to_extract, list) and information_to_extract == "rule_numbers":
+        # Merge the rule numbers of every term variant, keeping the first occurrence order
+        context = []
+        for term in key_to_extract:
+            rule_numbers = extract_information(output_file_with_terms, term, information_to_extract)
+            if isinstance(rule_numbers, list):
+                context.extend(rule for rule in rule_numbers if rule not in context)
+        if not context:
+            context = f"Technical term '{key_to_extract}' not found in the JSON file."
+    else:
+        context = extract_information(output_file_with_terms, str(key_to_extract), str(information_to_extract))
     result = {"key_to_extract": key_to_extract, "information_extracted": context}
     print(f'result is {result}')
     return result
 
 
 
-def generate_answers_and_update_df(file_path, question_column, llm_model):
+async def answer_question(client, question, llm_model, rephrase=False):
+    """
+    Retrieves the context for a single question and returns it as the answer.
+
+    The retrieved context is already the verbatim rule text (or list of rule numbers),
+    so a second model call is only made when `rephrase` is set.
+
+    Args:
+        client (AsyncOpenAI): The OpenAI client, shared by all requests of the run.
+        question (str): The question to answer.
+        llm_model (object): The AI model or handler to generate predictions (e.g., OpenAI GPT).
+        rephrase (bool): Whether to ask the model to restate the retrieved context.
+
+    Returns:
+        str: The model prediction for the question.
+    """
+    retrieved_context = await retrieve_context(client, llm_model, question)
+    print(f'question is {question}, retrieved_context is {retrieved_context}')
+    if not rephrase:
+        information_extracted = retrieved_context["information_extracted"]
+        if isinstance(information_extracted, list):
+            return ", ".join(str(rule) for rule in information_extracted)
+        return information_extracted
+
+    text = f"{retrieved_context}\n{question}"
+    prompt = """
+            You are an accurate and precise assistant. The user has asked the following question:
+            {question}
+            To help you respond appropriately, here is the provided context for reference:
+            {retrieved_context}
+
+            Instructions:
+            1. Use the exact context provided above to form your response for the given key or term.
+            2. Your answer **must only include the text from the provided context**, verbatim.
+            3. Do not add explanations, preambles, formatting, or any additional text to your response.
+
+            Simply return the exact context related to the key as the answer.
+
+            Example Input:
+            - Question: "What does rule V.1 state exactly?"
+            - Provided Context: {'key_to_extract': 'V.1', 'information_extracted': 'CONFIGURATION\nThe vehicle must be open wheeled and open cockpit (a formula style body) with four wheels\nthat are not in a straight line.'}
+            Example Output:
+            "CONFIGURATION\nThe vehicle must be open wheeled and open cockpit (a formula style body) with four wheels\nthat are not in a straight line."
+            """
+    # Generate model prediction
+    return await invoke_llm(client, llm_model, text, prompt=prompt)
+
+
+async def predict_answers(questions, llm_model, batch_size=10, rephrase=False):
+    """
+    Answers questions concurrently, awaiting one batch of requests at a time.
+
+    Args:
+        questions (list): The questions to answer.
+        llm_model (object): The AI model or handler to generate predictions (e.g., OpenAI GPT).
+        batch_size (int): Number of questions sent to the model concurrently.
+        rephrase (bool): Whether to ask the model to restate the retrieved context.
+
+    Returns:
+        list: The model predictions, in the same order as the questions.
+    """
+    predictions = []
+    # Initialize the OpenAI client (API key is automatically picked up from OPENAI_API_KEY environment variable)
+    # One pooled HTTP/2 client is shared by every request of the run
+    http_client = httpx.AsyncClient(http2=HTTP2, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    async with AsyncOpenAI(http_client=http_client) as client:
+        for start in range(0, len(questions), batch_size):
+            batch = questions[start:start + batch_size]
+            # A failed request (e.g. RateLimitError) is recorded for its row instead of aborting the batch
+            results = await asyncio.gather(*(answer_question(client, question, llm_model, rephrase) for question in batch),
+                                           return_exceptions=True)
+            for index, (question, prediction) in enumerate(zip(batch, results), start=start):
+                if isinstance(prediction, Exception):
+                    prediction = f"Error: {prediction}"
+                predictions.append(prediction)
+
+                # Optionally print progress
+                print(f"Row {index}: Question: {question} | Prediction: {prediction}")
+
+    return predictions
+
+
+def generate_answers_and_update_df(file_path, question_column, llm_model, batch_size=10, rephrase=False):
     """
     Generates answers for questions in a DataFrame and writes predictions into a new column.
 
     Args:
-        df (pandas.DataFrame): The input DataFrame containing a column with questions.
+        file_path (str): The path to the CSV file containing a column with questions.
         question_column (str): The column name in the DataFrame where the questions are stored.
-        context (str): The context to provide to the AI model for answering the questions.
         llm_model (object): The AI model or handler to generate predictions (e.g., OpenAI GPT).
+        batch_size (int): Number of questions sent to the model concurrently.
+        rephrase (bool): Whether to ask the model to restate the retrieved context.
 
     Returns:
         pandas.DataFrame: The updated DataFrame with a new column `[model prediction]`.
     """
     df, filename = read_csv_to_dataframe_with_filename(file_path)
-    # Initialize an empty list to store model predictions
-    predictions = []
-    df_test = df.copy().head(1)  # Create a copy of the DataFrame to avoid modifying the original
-
-    # Iterate through each row of the DataFrame
-    for index, row in df_test.iterrows():
-        question = row[question_column]
-        retrieved_context = retrieve_context(llm_model, question)
-        text = f"{retrieved_context}\n{question}"
-        print(f'question is {question}, retrieved_context is {retrieved_context}')
-        prompt = """
-                You are an accurate and precise assistant. The user has asked the following question:
-                {question}
-                To help you respond appropriately, here is the provided context for reference:
-                {retrieved_context}
-
-                Instructions:
-                1. Use the exact context provided above to form your response for the given key or term.
-                2. Your answer **must only include the text from the provided context**, verbatim.
-                3. Do not add explanations, preambles, formatting, or any additional text to your response.
-
-                Simply return the exact context related to the key as the answer.
-
-                Example Input:
-                - Question: "What does rule V.1 state exactly?"
-                - Provided Context: {'key_to_extract': 'V.1', 'information_extracted': 'CONFIGURATION\nThe vehicle must be open wheeled and open cockpit (a formula style body) with four wheels\nthat are not in a straight line.'}
-                Example Output:
-                "CONFIGURATION\nThe vehicle must be open wheeled and open cockpit (a formula style body) with four wheels\nthat are not in a straight line."
-                """
-        # Generate model prediction
-        try:
-            prediction = invoke_llm(llm_model, text, prompt=prompt)
-            
-        except Exception as e:
-            prediction = f"Error: {e}"
-
-        # Append the prediction to the list
-        predictions.append(prediction)
 
-        # Optionally print progress
-        print(f"Row {index}: Question: {question} | Prediction: {prediction}")
+    # Answer the questions concurrently in batches
+    questions = df[question_column].tolist()
+    predictions = asyncio.run(predict_answers(questions, llm_model, batch_size=batch_size, rephrase=rephrase))
 
     # Add the predictions as a new column in the DataFrame
-    df[['model prediction']] = predictions
+    df['model prediction'] = predictions
     file_path = "../eval/"
     new_filename = file_path + f"{filename}_{llm_model}.csv"
     # Save the DataFrame to CSV
@@ -289,14 +370,25 @@ def generate_answers_and_update_df(file_path, question_column, llm_model):
     return df
 
 
-file_path = '../../dataset/rule_extraction/rule_retrieval_qa.csv'
-df, filename = read_csv_to_dataframe_with_filename(file_path)
+if __name__ == "__main__":
+    # Guarded so that the helpers can be imported, e.g. by the tests, without re-running the script
+    # Example lookups
+    key1 = 'V.1.2'  # Example key to extract
+    key2 = "rollover stability"
+
+    result1 = extract_information(output_file_with_terms, key1, "definition")
+    print(result1)
+    result2 = extract_information(output_file_with_terms, key2, "rule_numbers")
+    print(result2)
+
+    file_path = '../../dataset/rule_extraction/rule_retrieval_qa.csv'
+    df, filename = read_csv_to_dataframe_with_filename(file_path)
 
-# Process the DataFrame with the questions and update it with predictions
-updated_df = generate_answers_and_update_df(file_path=file_path, question_column="question", llm_model='gpt-5-nano')
+    # Process the DataFrame with the questions and update it with predictions
+    updated_df = generate_answers_and_update_df(file_path=file_path, question_column="question", llm_model='gpt-5-nano')
 
-# Print updated DataFrame
-print(updated_df[['model prediction']])
+    # Print updated DataFrame
+    print(updated_df[['model prediction']])
 
 
 """
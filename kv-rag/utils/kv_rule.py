@@ -1,14 +1,76 @@
 import os
-import json
+import logging
+import orjson
 import sys
+import time
+import hashlib
+import asyncio
 from dotenv import load_dotenv
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, OpenAI, RateLimitError
+from kv_common import (HTTP2, HTTP_LIMITS, HTTP_TIMEOUT, OUTPUT_TOKENS_LIMIT, REASONING_OUTPUT_TOKENS, is_truncated,
+                       read_json, response_output_text)
 
 
-# Load .env from the parent directory (adjust path if needed)
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '../../.env'))
+# Load .env from the parent directory (adjust path if needed), unless the key is already in the environment
+if "OPENAI_API_KEY" not in os.environ:
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '../../.env'))
 #api_key = os.getenv("OPENAI_API_KEY")
 
+# Per-page progress is logged at DEBUG, so nothing is written in the request loop at the default INFO level
+log = logging.getLogger(__name__)
+
+# Delimiter placed before each page when several pages are sent in one request
+PAGE_DELIMITER = "===PAGE {page}==="
+BATCH_INSTRUCTION = """The text below contains one or more pages, each starting with a line of the form ===PAGE k===.
+Return one JSON object with top-level keys equal to the page numbers k (as strings), where each value
+is the output requested above for that page only."""
+
+# Model tiers: plain term extraction runs on the smallest model, structured rule extraction on the next one up.
+# A response that is not valid JSON is retried once per step up the escalation chain.
+TERM_MODEL = "gpt-5-nano"
+RULE_MODEL = "gpt-5-mini"
+MODEL_ESCALATION = {"gpt-5-nano": "gpt-5-mini", "gpt-5-mini": "gpt-5"}
+
+# Cap on generated tokens per request, since latency grows with the number of generated tokens. The rules are
+# copied verbatim with their keys, so each page gets about twice its own tokens (~4 characters each), and the
+# request gets REASONING_OUTPUT_TOKENS on top for the model's reasoning tokens
+OUTPUT_TOKENS_PER_PAGE_CHARACTER = 0.5
+
+# Compact structured output for rule extraction: {page: {rule: {page_number, rule_number, definition}}}
+RULES_TEXT_FORMAT = {
+    "format": {
+        "type": "json_schema",
+        "name": "rules_by_page",
+        "strict": False,  # Page and rule numbers are dynamic keys, which strict schemas do not allow
+        "schema": {
+            "type": "object",
+            "additionalProperties": {
+                "type": "object",
+                "additionalProperties": {
+                    "type": "object",
+                    "properties": {
+                        "page_number": {"type": "string"},
+                        "rule_number": {"type": "string"},
+                        "definition": {"type": "string"},
+                    },
+                    "required": ["page_number", "rule_number", "definition"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+    }
+}
+
+DEFAULT_TERM_PROMPT = """You are a knowledgeable assistant specializing in technical terms and definitions. 
+    Your task is to extract key terms from the provided text. Here are some examples of key terms: 
+    "Aerodynamic, Tractive System, Shutdown System, Accelerator Pedal Position Sensor, Brake Pedal,
+    Material properties, material, External Item, Impact Attenuator, Accumulator, Firewall, Powertrain, 
+    Catch Cans, Thermal Protection, Scatter Shields, Coolant, Butt Joints/Butt Joint, Inertia Switch, Transponder,
+    Brake Over Travel Switch, Wiring, Grounded Low Voltage, Grounding, Lighting, Light". After extracting the key terms,
+    write them in json format. {terms}: key terms separated by comma in a list
+    """
+
 
 def select_dictionary_range(input_dict, start_key, end_key):
     """
@@ -22,9 +84,14 @@ def select_dictionary_range(input_dict, start_key, end_key):
     Returns:
         dict: A dictionary containing only the items within the specified range.
     """
-    # Filter dictionary items within the range using dictionary comprehension
-    selected_items = {key: value for key, value in input_dict.items() if start_key <= int(key) <= end_key}
-    print(f"Selected {len(selected_items)} items from page {start_key} to {end_key}.")
+    # Look up each page of the range directly instead of scanning and parsing every key
+    selected_items = {}
+    for page in range(start_key, end_key + 1):
+        for key in (str(page), page):  # Page keys are strings when loaded from JSON
+            if key in input_dict:
+                selected_items[key] = input_dict[key]
+                break
+    log.info("Selected %d items from page %s to %s.", len(selected_items), start_key, end_key)
 
     return selected_items
 
@@ -39,153 +106,526 @@ def update_json_if_different(json_file, new_data):
         new_data (dict): The new dictionary to add or update.
 
     Returns:
-        None
-    """
-    # Check if the JSON file exists; if not, initialize it as an empty list
-    if not os.path.exists(json_file):
-        with open(json_file, "w", encoding="utf-8") as file:
-            json.dump([], file)  # Start with an empty list
-
-    # Load existing data from the JSON file
-    with open(json_file, "r", encoding="utf-8") as file:
-        try:
-            existing_data = json.load(file)
-        except json.JSONDecodeError:
-            existing_data = {}  # In case the file is empty or corrupted
-        # Check if `new_data` matches any dictionary in `existing_data`
+        dict: The merged data.
+    """
+    # Load existing data from the JSON file, starting empty if it does not exist yet
+    try:
+        with open(json_file, "rb") as file:
+            existing_data = orjson.loads(file.read())
+    except FileNotFoundError:
+        existing_data = {}
+    except orjson.JSONDecodeError:
+        existing_data = {}  # In case the file is empty or corrupted
     
+    # Merge only the entries that are new or different, remembering whether anything changed
+    changed = False
     for key, value in new_data.items():
-        #print(f"Checking if key '{key}' with value '{value}' exists in the existing data...")
-        # Check if the key exists and the value matches in the existing dictionary
-        if key in existing_data and existing_data[key] == value:
-            #print(f"Key '{key}' with value '{value}' already exists. Skipping...")
-            pass
-        else:
-            # Add or update the key-value pair in the existing dictionary
-            #print(f"Key '{key}' with value '{value}' does not exist or is different. Adding/updating...")
+        if existing_data.get(key) != value:
             existing_data[key] = value
-            #print(f"Key '{key}' with value '{value}' added to the dictionary.")
-    with open(json_file, "w", encoding="utf-8") as file:
-        json.dump(dict(sorted(existing_data.items())), file, indent=4)
-        print("The new data has been added to the JSON file.")
+            changed = True
+
+    if changed:
+        # Serialize once (sorted by page) and write it through a large buffer to keep the number of write calls low
+        with open(json_file, "wb", buffering=262144) as file:
+            file.write(orjson.dumps(existing_data, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2))
+            log.info("The new data has been added to the JSON file.")
+    else:
+        log.info("The JSON file is already up to date.")
     
     return existing_data
 
 
 
-def extract_rules_gpt(page_content_dict, output_json, prompt=None, start_page=1, end_page=2):
+def _build_batch_input(prompt, batch):
     """
-    Extract technical terms using OpenAI GPT and their definitions.
+    Builds the model input for a batch of pages, marking where each page starts.
 
     Args:
-        page_content_dict (dict): Dictionary containing page content.
-        output_json (str): Path to save extracted terms and definitions as JSON.
-        prompt (str, optional): Custom prompt for GPT model.
+        prompt (str): Instruction prompt for GPT model.
+        batch (list): List of (page_number, page_content) tuples.
+
+    Returns:
+        str: The prompt, the batch instruction and the delimited page texts.
     """
+    page_texts = [f"{PAGE_DELIMITER.format(page=page_number)}\n{page_content}" for page_number, page_content in batch]
+    log.debug("Processing pages %s with content length: %d characters, and context is %s...",
+              [page_number for page_number, _ in batch], sum(map(len, page_texts)), page_texts[0][:100])  # Log first 100 characters for context
+    # Join everything in a single allocation, with the static instructions first
+    return "\n\n".join([prompt, BATCH_INSTRUCTION, *page_texts])
+
+
+def _decode_batch_output(output_text):
+    """
+    Decodes the model's response for a batch.
+
+    Args:
+        output_text (str): The model's response, expected to be a JSON object keyed by page number.
+
+    Returns:
+        dict: The decoded response, or None when it is not a JSON object.
+    """
+    try:
+        batch_results = orjson.loads(output_text)
+    except orjson.JSONDecodeError:
+        return None
+    return batch_results if isinstance(batch_results, dict) else None
+
+
+def _split_batch_results(batch_results, page_numbers):
+    """
+    Splits the model's decoded response for a batch back into pages.
+
+    Args:
+        batch_results (dict): The decoded response, a JSON object keyed by page number.
+        page_numbers (list): The page numbers that were sent in the batch.
+
+    Returns:
+        dict: The extracted results for each page found in the response.
+    """
+    results = {}
+    for page_number in page_numbers:
+        if page_number in batch_results:
+            results[page_number] = batch_results[page_number]
+            log.debug("Extracted results for page %s: %s", page_number, results[page_number])
+        else:
+            log.warning("No results returned for page %s", page_number)
+    return results
+
+
+def _max_output_tokens(batch):
+    """
+    Sizes the output token cap of a request from the length of its pages.
+
+    Args:
+        batch (list): List of (page_number, page_content) tuples.
+
+    Returns:
+        int: The cap on generated tokens, reasoning included.
+    """
+    page_characters = sum(len(str(page_content)) for _, page_content in batch)
+    return REASONING_OUTPUT_TOKENS + int(page_characters * OUTPUT_TOKENS_PER_PAGE_CHARACTER)
+
+
+def _request_options(prompt, batch, text_format=None, model=TERM_MODEL):
+    """
+    Builds the arguments of a Responses API request for a batch of pages.
+
+    Args:
+        prompt (str): Instruction prompt for GPT model.
+        batch (list): List of (page_number, page_content) tuples.
+        text_format (dict, optional): Structured output format for the response.
+        model (str, optional): The model to use.
+
+    Returns:
+        dict: Keyword arguments for `client.responses.create` (also used as a Batch API body).
+    """
+    options = {
+        "model": model,  # Specify the model to use
+        "input": _build_batch_input(prompt, batch),  # Combine prompt and context
+        "max_output_tokens": _max_output_tokens(batch),
+    }
+    if text_format is not None:
+        options["text"] = text_format
+    return options
+
+
+async def _extract_rules_batch(client, semaphore, page_numbers, options, max_retries=5):
+    """
+    Sends one batch of pages to the model and splits the response back into pages.
+    When the response was cut off at `max_output_tokens`, the batch is sent again with the cap doubled;
+    when it is otherwise not valid JSON, it is sent again to the next larger model in MODEL_ESCALATION.
+
+    Args:
+        client (AsyncOpenAI): The OpenAI client.
+        semaphore (asyncio.Semaphore): Bounds the number of requests in flight.
+        page_numbers (list): The page numbers sent in the batch.
+        options (dict): Prebuilt request arguments, see `_request_options`.
+        max_retries (int, optional): Number of attempts when the API rate limit is hit.
+
+    Returns:
+        dict: The extracted results for each page of the batch.
+    """
+
+    async with semaphore:
+        while True:
+            # Create a chat completion, backing off exponentially when rate limited
+            for attempt in range(max_retries):
+                try:
+                    response = await client.responses.create(**options)
+                    break
+                except RateLimitError:
+                    if attempt == max_retries - 1:
+                        raise
+                    delay = 2 ** attempt
+                    log.warning("Rate limited on pages %s, retrying in %s seconds", page_numbers, delay)
+                    await asyncio.sleep(delay)
+
+            batch_results = _decode_batch_output(response.output_text)
+            if batch_results is not None:
+                break
+            if is_truncated(response):
+                # A larger model would be cut off at the same cap, so raise the cap instead
+                if options["max_output_tokens"] >= OUTPUT_TOKENS_LIMIT:
+                    log.warning("Results for pages %s were cut off at %d tokens", page_numbers,
+                                options['max_output_tokens'])
+                    return {}
+                max_output_tokens = min(2 * options["max_output_tokens"], OUTPUT_TOKENS_LIMIT)
+                log.warning("Results for pages %s were cut off, retrying with %d output tokens", page_numbers,
+                            max_output_tokens)
+                options = {**options, "max_output_tokens": max_output_tokens}
+                continue
+            # Escalate to a larger model only for the batches the smaller one could not answer
+            larger_model = MODEL_ESCALATION.get(options["model"])
+            if larger_model is None:
+                log.warning("Could not decode results for pages %s", page_numbers)
+                return {}
+            log.warning("Could not decode results for pages %s from %s, retrying with %s", page_numbers,
+                        options['model'], larger_model)
+            options = {**options, "model": larger_model}
+
+    return _split_batch_results(batch_results, page_numbers)
+
+
+def _page_hash(prompt, page_content):
+    """Hashes the prompt together with the page content, so a changed prompt re-processes the page."""
+    return hashlib.sha1((prompt + "\0" + page_content).encode("utf-8")).hexdigest()
+
+
+def _prompt_hash(prompt):
+    """Hashes the prompt alone, to tell which prompt a checkpoint line was extracted with."""
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+
+
+def _load_page_hashes(output_json):
+    """
+    Loads the hashes of already-processed pages, kept in a sidecar file next to the output JSON
+    so that the output itself only contains page keys.
+
+    Args:
+        output_json (str): Path of the output JSON file.
+
+    Returns:
+        dict: A dictionary mapping page numbers to content hashes.
+    """
+    try:
+        return read_json(output_json + ".hashes")
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+
+def _save_page_hashes(output_json, page_hashes):
+    """Saves the hashes of processed pages next to the output JSON file."""
+    with open(output_json + ".hashes", "wb") as file:
+        file.write(orjson.dumps(page_hashes))
+
+
+def _skip_processed_pages(context, prompt, page_hashes):
+    """
+    Removes pages whose prompt and content are unchanged since they were last extracted.
+
+    Args:
+        context (dict): Dictionary containing the selected page content.
+        prompt (str): Instruction prompt for GPT model.
+        page_hashes (dict): Hashes of the already-processed pages.
+
+    Returns:
+        dict: The pages that still need to be sent to the model.
+    """
+    pending = {
+        page_number: page_content for page_number, page_content in context.items()
+        if page_hashes.get(page_number) != _page_hash(prompt, page_content)
+    }
+    if len(pending) < len(context):
+        log.info("Skipping %d pages that were already processed.", len(context) - len(pending))
+    return pending
 
-    context = select_dictionary_range(page_content_dict, start_page, end_page)
-    #print(context)
+
+def _record_processed_pages(output_json, context, prompt, page_hashes, results):
+    """Records the hashes of the pages of `context` that were extracted successfully."""
+    for page_number in results:
+        if page_number in context:
+            page_hashes[page_number] = _page_hash(prompt, context[page_number])
+    _save_page_hashes(output_json, page_hashes)
+
+
+def _load_partial_results(partial_path, prompt):
+    """
+    Folds the checkpoint of an interrupted run back into a dictionary. Each line holds
+    {"prompt": <prompt hash>, "results": {page: ...}}; lines extracted with a different prompt are
+    dropped, so their pages are sent again and never recorded as processed with the current prompt.
+
+    Args:
+        partial_path (str): Path of the append-only JSONL checkpoint file.
+        prompt (str): Instruction prompt of the current run.
+
+    Returns:
+        dict: The results saved so far for each page.
+    """
+    results = {}
+    if not os.path.exists(partial_path):
+        return results
+    prompt_hash = _prompt_hash(prompt)
+    with open(partial_path, "rb") as file:
+        for line in file:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                log.warning("Skipping an incomplete line in %s", partial_path)
+                continue
+            if record.get("prompt") != prompt_hash:
+                log.info("Skipping checkpointed pages %s that were extracted with another prompt",
+                         list(record.get("results", {})))
+                continue
+            results.update(record["results"])
+    return results
+
+
+async def _extract_rules_async(context, prompt, batch_size, max_concurrency, text_format=None, checkpoint=None,
+                               model=TERM_MODEL):
+    """
+    Runs all page batches concurrently, with at most `max_concurrency` requests in flight.
+
+    Args:
+        context (dict): Dictionary containing the selected page content.
+        prompt (str): Instruction prompt for GPT model.
+        batch_size (int): Number of pages sent in a single request.
+        max_concurrency (int): Maximum number of concurrent requests.
+        text_format (dict, optional): Structured output format for the responses.
+        checkpoint (file, optional): Binary file each finished batch is appended to as a JSON line,
+            together with the hash of the prompt it was extracted with.
+        model (str, optional): The model the batches are sent to first.
+
+    Returns:
+        dict: The extracted results for every page that succeeded.
+    """
+    async def run_batch(page_numbers, options):
+        batch_result = await _extract_rules_batch(client, semaphore, page_numbers, options)
+        # Persist the batch as soon as it is done, so a later failure does not lose it
+        if checkpoint is not None and batch_result:
+            checkpoint.write(orjson.dumps({"prompt": prompt_hash, "results": batch_result}) + b"\n")
+            checkpoint.flush()
+        return batch_result
+
+    pages = list(context.items())
+    batches = [pages[start:start + batch_size] for start in range(0, len(pages), batch_size)]
+    # Build every request input up front, so the concurrent path only sends them
+    requests = [([page_number for page_number, _ in batch], _request_options(prompt, batch, text_format, model)) for batch in batches]
+    semaphore = asyncio.Semaphore(max_concurrency)
+    prompt_hash = _prompt_hash(prompt)
 
     # Initialize the OpenAI client (API key is automatically picked up from OPENAI_API_KEY environment variable)
-    client = OpenAI()
+    # One pooled HTTP/2 client is shared by every request of the run
+    http_client = httpx.AsyncClient(http2=HTTP2, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    async with AsyncOpenAI(http_client=http_client) as client:
+        batch_results = await asyncio.gather(
+            *(run_batch(page_numbers, options) for page_numbers, options in requests),
+            return_exceptions=True,
+        )
+
     results = {}
-    
-    for page_number, page_content in context.items():
-
-        # Load text from file
-        text = f"\nPage {page_number}\n\n{page_content}" 
-        print(f"Processing page {page_number} with content length: {len(text)} characters, and context is {text[:100]}...")  # Print first 100 characters for context
-        # Define default prompt if none is provided
-        if prompt is None:
-            prompt = """You are a knowledgeable assistant specializing in technical terms and definitions. 
-                Your task is to extract key terms from the provided text. Here are some examples of key terms: 
-                "Aerodynamic, Tractive System, Shutdown System, Accelerator Pedal Position Sensor, Brake Pedal,
-                Material properties, material, External Item, Impact Attenuator, Accumulator, Firewall, Powertrain, 
-                Catch Cans, Thermal Protection, Scatter Shields, Coolant, Butt Joints/Butt Joint, Inertia Switch, Transponder,
-                Brake Over Travel Switch, Wiring, Grounded Low Voltage, Grounding, Lighting, Light". After extracting the key terms,
-                write them in json format. {terms}: key terms separated by comma in a list
-                """
-
-        # Create a chat completion
-        try:
-            response = client.responses.create(
-                model="gpt-5-nano",  # Specify the model to use
-                input=prompt + "\n\n" + text,  # Combine prompt and context
-            )
-
-            # Access and print the model's response
-            results[page_number] = response.output_text
-            print(f"Extracted technical terms for page {page_number}: {results[page_number]}")
-
-        except Exception as e:
-            print(f"An error occurred: {e}")
+    for (page_numbers, _), batch_result in zip(requests, batch_results):
+        if isinstance(batch_result, Exception):
+            log.error("An error occurred for pages %s: %s", page_numbers, batch_result)
+        else:
+            results.update(batch_result)
+    return results
+
+
+def _extract_pages(page_content_dict, output_json, prompt, start_page, end_page, batch_size, max_concurrency,
+                   text_format=None, model=TERM_MODEL):
+    """
+    Shared core of the extraction functions: selects the page range, sends the pages that were
+    not processed yet to the model and merges the results into the output JSON file.
+
+    Args:
+        page_content_dict (dict): Dictionary containing page content.
+        output_json (str): Path to save the extracted results as JSON.
+        prompt (str, optional): Custom prompt for GPT model. Defaults to DEFAULT_TERM_PROMPT.
+        start_page (int): Starting page number for extraction.
+        end_page (int): Ending page number for extraction.
+        batch_size (int): Number of pages sent in a single request.
+        max_concurrency (int): Maximum number of concurrent requests, sized to the rate limit.
+        text_format (dict, optional): Structured output format for the responses.
+        model (str, optional): The model the pages are sent to first.
+
+    Returns:
+        dict: The extracted results for every page that succeeded.
+    """
+    context = select_dictionary_range(page_content_dict, start_page, end_page)
+    #print(context)
+
+    # Define default prompt if none is provided
+    if prompt is None:
+        prompt = DEFAULT_TERM_PROMPT
+
+    # Skip pages whose content was already extracted with the same prompt
+    page_hashes = _load_page_hashes(output_json)
+    pending = _skip_processed_pages(context, prompt, page_hashes)
+
+    # Resume from the checkpoint of an interrupted run, then append each finished batch to it
+    partial_path = output_json + ".partial.jsonl"
+    partial_results = _load_partial_results(partial_path, prompt)
+    if partial_results:
+        log.info("Resuming with %d pages from %s.", len(partial_results), partial_path)
+    pending = {page_number: page_content for page_number, page_content in pending.items() if page_number not in partial_results}
+    with open(partial_path, "ab", buffering=65536) as checkpoint:
+        results = asyncio.run(_extract_rules_async(pending, prompt, batch_size, max_concurrency, text_format, checkpoint,
+                                                   model))
+    results = {**partial_results, **results}
 
     # Save the results to the output JSON file
     # Call the function to check and update the JSON file
     update_json_if_different(output_json, results)
-    # with open(output_json, "w", encoding="utf-8") as json_file:
-    #     json.dump(results, json_file, indent=4)
-    print(f"Technical terms and definitions extracted using GPT saved to {output_json}")    
+    _record_processed_pages(output_json, context, prompt, page_hashes, results)
+    os.remove(partial_path)  # Everything is in the output file now
+    return results
+
+
+def extract_rules_gpt(page_content_dict, output_json, prompt=None, start_page=1, end_page=2, batch_size=4,
+                      max_concurrency=20, model=RULE_MODEL):
+    """
+    Extract technical terms using OpenAI GPT and their definitions.
+
+    Pages are sent `batch_size` at a time, each marked with a `===PAGE k===` delimiter,
+    so that the long instruction prompt is paid once per batch instead of once per page.
+    Batches are requested concurrently and answered with the compact RULES_TEXT_FORMAT schema,
+    with generated tokens capped per page. The static prompt always comes first in the input so
+    that repeated requests share the server-side prompt cache, and pages already extracted
+    with the same prompt and content are skipped.
 
-def extract_technical_terms_gpt(input_file, output_file, prompt=None,start_page=1,end_page=2):
+    Args:
+        page_content_dict (dict): Dictionary containing page content.
+        output_json (str): Path to save extracted terms and definitions as JSON.
+        prompt (str, optional): Custom prompt for GPT model.
+        start_page (int, optional): Starting page number for extraction.
+        end_page (int, optional): Ending page number for extraction.
+        batch_size (int, optional): Number of pages sent in a single request.
+        max_concurrency (int, optional): Maximum number of concurrent requests, sized to the rate limit.
+        model (str, optional): The model to use; batches it cannot answer as JSON escalate to a larger one.
+    """
+    _extract_pages(page_content_dict, output_json, prompt, start_page, end_page, batch_size, max_concurrency,
+                   text_format=RULES_TEXT_FORMAT, model=model)
+    log.info("Technical terms and definitions extracted using GPT saved to %s", output_json)    
+
+
+def extract_technical_terms_gpt(input_file, output_file, prompt=None, start_page=1, end_page=2, batch_size=4,
+                                max_concurrency=20, model=TERM_MODEL):
     """
     Extract technical terms using OpenAI GPT and their definitions.
 
     Args:
-        input_folder (str): Path to the folder containing input JSON files.
-        output_folder (str): Path to the folder where output JSON files will be saved.
+        input_file (str): Path to the JSON file containing the page content.
+        output_file (str): Path to save extracted terms and definitions as JSON.
         prompt (str, optional): Custom prompt for GPT model.
         start_page (int, optional): Starting page number for extraction.
         end_page (int, optional): Ending page number for extraction.
+        batch_size (int, optional): Number of pages sent in a single request.
+        max_concurrency (int, optional): Maximum number of concurrent requests, sized to the rate limit.
+        model (str, optional): The model to use; batches it cannot answer as JSON escalate to a larger one.
     """
-    # Ensure the output file exists
-    if not os.path.exists(os.path.dirname(output_file)):
-        os.makedirs(os.path.dirname(output_file))
+    # Ensure the output folder exists
+    output_folder = os.path.dirname(output_file)
+    if output_folder and not os.path.exists(output_folder):
+        os.makedirs(output_folder)
 
+    page_content_dict = read_json(input_file)
+
+    _extract_pages(page_content_dict, output_file, prompt, start_page, end_page, batch_size, max_concurrency,
+                   model=model)
+    log.info("Technical terms and definitions extracted using GPT saved to %s", output_file)
+
+
+def _batch_for_custom_id(batches, custom_id):
+    """Returns the batch of pages a Batch API custom_id of the form pages-<index> refers to, or None."""
+    prefix, _, index = str(custom_id).rpartition("-")
+    if prefix != "pages" or not index.isdecimal() or int(index) >= len(batches):
+        return None
+    return batches[int(index)]
+
+
+def extract_rules_gpt_batch(page_content_dict, output_json, prompt=None, start_page=1, end_page=2, batch_size=4,
+                            batch_file='../files/extract_rules_batch.jsonl', poll_interval=60, model=RULE_MODEL):
+    """
+    Extract rules using the OpenAI Batch API, for long offline runs over the full rulebook.
+    Batch requests cost half as much and use a separate rate limit pool, but may take up to 24 hours.
+
+    Args:
+        page_content_dict (dict): Dictionary containing page content.
+        output_json (str): Path to save extracted rules as JSON.
+        prompt (str, optional): Custom prompt for GPT model. Defaults to DEFAULT_TERM_PROMPT.
+        start_page (int, optional): Starting page number for extraction.
+        end_page (int, optional): Ending page number for extraction.
+        batch_size (int, optional): Number of pages sent in a single request.
+        batch_file (str, optional): Path of the JSONL request file to upload.
+        poll_interval (int, optional): Seconds to wait between batch status checks.
+        model (str, optional): The model to use.
+    """
     context = select_dictionary_range(page_content_dict, start_page, end_page)
-    #print(context)
+    if prompt is None:
+        prompt = DEFAULT_TERM_PROMPT
+
+    # Skip pages whose content was already extracted with the same prompt
+    page_hashes = _load_page_hashes(output_json)
+    context = _skip_processed_pages(context, prompt, page_hashes)
+    if not context:
+        log.info("All pages were already processed.")
+        return
+    pages = list(context.items())
+    batches = [pages[start:start + batch_size] for start in range(0, len(pages), batch_size)]
+
+    # Write one request per batch of pages
+    with open(batch_file, "wb") as file:
+        for index, batch in enumerate(batches):
+            request = {
+                "custom_id": f"pages-{index}",
+                "method": "POST",
+                "url": "/v1/responses",
+                "body": _request_options(prompt, batch, RULES_TEXT_FORMAT, model),
+            }
+            file.write(orjson.dumps(request) + b"\n")
 
     # Initialize the OpenAI client (API key is automatically picked up from OPENAI_API_KEY environment variable)
-    client = OpenAI()
+    client = OpenAI(http_client=httpx.Client(http2=HTTP2, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT))
+    with open(batch_file, "rb") as file:
+        input_file = client.files.create(file=file, purpose="batch")
+    batch_job = client.batches.create(input_file_id=input_file.id, endpoint="/v1/responses", completion_window="24h")
+    log.info("Submitted batch %s with %d requests.", batch_job.id, len(batches))
+
+    # Poll until the batch reaches a final state
+    while batch_job.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch_job = client.batches.retrieve(batch_job.id)
+        log.info("Batch %s status: %s", batch_job.id, batch_job.status)
+
+    if batch_job.status != "completed" or batch_job.output_file_id is None:
+        log.info("Batch %s finished with status %s; no results were saved.", batch_job.id, batch_job.status)
+        return
+
+    # Map each output line back to its pages through the custom_id
     results = {}
+    output = client.files.content(batch_job.output_file_id).text
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        batch = _batch_for_custom_id(batches, record.get("custom_id"))
+        if batch is None:
+            log.warning("Skipping a result with unknown custom_id %r", record.get("custom_id"))
+            continue
+        page_numbers = [page_number for page_number, _ in batch]
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            log.error("An error occurred for pages %s: %s", page_numbers, record.get('error') or response)
+            continue
+        batch_results = _decode_batch_output(response_output_text(response["body"]))
+        if batch_results is None:
+            log.warning("Could not decode results for pages %s", page_numbers)
+            continue
+        results.update(_split_batch_results(batch_results, page_numbers))
 
-    for page_number, page_content in context.items():
-
-        # Load text from file
-        text = f"\nPage {page_number}\n\n{page_content}"
-        print(f"Processing page {page_number} with content length: {len(text)} characters, and context is {text[:100]}...")  # Print first 100 characters for context
-        # Define default prompt if none is provided
-        if prompt is None:
-            prompt = """You are a knowledgeable assistant specializing in technical terms and definitions.
-                Your task is to extract key terms from the provided text. Here are some examples of key terms:
-                "Aerodynamic, Tractive System, Shutdown System, Accelerator Pedal Position Sensor, Brake Pedal,
-                Material properties, material, External Item, Impact Attenuator, Accumulator, Firewall, Powertrain,
-                Catch Cans, Thermal Protection, Scatter Shields, Coolant, Butt Joints/Butt Joint, Inertia Switch, Transponder,
-                Brake Over Travel Switch, Wiring, Grounded Low Voltage, Grounding, Lighting, Light". After extracting the key terms,
-                write them in json format. {terms}: key terms separated by comma in a list
-                """
-
-        # Create a chat completion
-        try:
-            response = client.responses.create(
-                model="gpt-5-nano",  # Specify the model to use
-                input=prompt + "\n\n" + text,  # Combine prompt and context
-            )
-
-            # Access and print the model's response
-            results[page_number] = response.output_text
-            print(f"Extracted technical terms for page {page_number}: {results[page_number]}")
-
-        except Exception as e:
-            print(f"An error occurred: {e}")
-
-    # Save the results to the output JSON file
-    # Call the function to check and update the JSON file
     update_json_if_different(output_json, results)
-    # with open(output_json, "w", encoding="utf-8") as json_file:
-    #     json.dump(results, json_file, indent=4)
-    print(f"Technical terms and definitions extracted using GPT saved to {output_json}")
-
+    _record_processed_pages(output_json, context, prompt, page_hashes, results)
+    log.info("Rules extracted using the GPT Batch API saved to %s", output_json)
 
 prompt_rule_extraction = """
 "You are tasked with processing a technically formatted document to build a structured lookup table in JSON format. 
@@ -241,26 +681,6 @@ Lookup Table for Rules:
 }
 
 """
-text_file = '../files/cln_rules.txt'  # Path to the text file containing extracted content
-text_json = '../files/cln_rules.json'
-output_json = '../files/extracted_rules.json'
-
-with open(text_json, "r", encoding="utf-8") as file:
-    # Load the JSON content into a dictionary
-    page_content_dict = json.load(file)
-    print(f"Loaded {len(page_content_dict)} pages from {text_json}")
-
-# Define the start and end page numbers for extraction
-start_page = 16  # Starting page number
-end_page = 18  #len(page_content_dict)   # Ending page number
-extract_rules_gpt(
-    page_content_dict=page_content_dict,
-    output_json=output_json,
-    prompt=prompt_rule_extraction,
-    start_page=start_page,
-    end_page=end_page   
-)
-
 
 
 """
@@ -448,4 +868,29 @@ if numerical value is not present, state NONE for dimension, mechanical, functio
 - If the definition includes a specific measurement or property or function or temperature (e.g., "1525 mm", "tensile strength of 300 MPa", "input force of 2000 N", "resistor value of 3kOhm "operating temperature of 100°C"), 
 extract the value and its unit. If more than one measurement is available for a single definition, include all relevant measurements in the output.
 
-"""
\ No newline at end of file
+"""
+
+
+if __name__ == "__main__":
+    # Guarded so that the helpers can be imported, e.g. by the tests, without re-running the script
+    text_file = '../files/cln_rules.txt'  # Path to the text file containing extracted content
+    text_json = '../files/cln_rules.json'
+    output_json = '../files/extracted_rules.json'
+
+    # Set LOGLEVEL=DEBUG to see per-page progress
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"), format="%(message)s")
+
+    # Load the JSON content into a dictionary
+    page_content_dict = read_json(text_json)
+    log.info("Loaded %d pages from %s", len(page_content_dict), text_json)
+
+    # Define the start and end page numbers for extraction
+    start_page = 16  # Starting page number
+    end_page = 18  #len(page_content_dict)   # Ending page number
+    extract_rules_gpt(
+        page_content_dict=page_content_dict,
+        output_json=output_json,
+        prompt=prompt_rule_extraction,
+        start_page=start_page,
+        end_page=end_page   
+    )
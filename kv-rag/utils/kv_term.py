@@ -1,15 +1,137 @@
 import os
-import json
+import re
+import orjson
+import logging
 import sys
+import time
+import hashlib
+import asyncio
+import ijson
 from dotenv import load_dotenv
-from openai import OpenAI
-from collections import defaultdict
+import httpx
+from openai import AsyncOpenAI, OpenAI, RateLimitError
+from collections import deque
+from functools import lru_cache
+from kv_common import (HTTP2, HTTP_LIMITS, HTTP_TIMEOUT, OUTPUT_TOKENS_LIMIT, REASONING_OUTPUT_TOKENS, is_truncated,
+                       persistent_cache, read_json, read_records, response_output_text, write_json)
 
 
-# Load .env from the parent directory (adjust path if needed)
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '../../.env'))
+# Load .env from the parent directory (adjust path if needed), unless the key is already in the environment
+if "OPENAI_API_KEY" not in os.environ:
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '../../.env'))
 #api_key = os.getenv("OPENAI_API_KEY")    
 
+# Per-rule progress is logged at DEBUG, so nothing is formatted or written per rule at the default INFO level
+log = logging.getLogger(__name__)
+
+
+def _decode_rules(page, rules):
+    """Decodes the rules of a page if they are string-encoded, returning None when they cannot be decoded."""
+    if isinstance(rules, str):
+        try:
+            return orjson.loads(rules)
+        except orjson.JSONDecodeError:
+            log.warning("Could not decode rules for page %s", page)
+            return None
+    return rules
+
+
+def _rule_records(page, rules):
+    """Encodes the rules of one page as JSONL records, one line per rule."""
+    return b"".join(
+        orjson.dumps({"page": page, "rule": rule, "details": details}, option=orjson.OPT_APPEND_NEWLINE)
+        for rule, details in rules.items()
+    )
+
+
+# Model tiers: batches of short definitions go to the small model, batches holding a long one to the larger model
+SMALL_MODEL = "gpt-5-nano"
+LARGE_MODEL = "gpt-5-mini"
+LONG_DEFINITION_CHARS = 400
+# Cap on generated tokens, per rule plus about one per input token and REASONING_OUTPUT_TOKENS for the model's
+# reasoning; latency grows with the number of generated tokens
+OUTPUT_TOKENS_PER_RULE = 400
+
+# Raw model responses keyed by a hash of the model and request input, kept between runs
+llm_cache_file = '../files/invoke_llm.cache.pkl'
+_llm_cache = persistent_cache(llm_cache_file)
+
+# Delimiter placed before each rule definition when several rules are sent in one request
+RULE_DELIMITER = "===RULE {rule}==="
+BATCH_INSTRUCTION = """The text below contains one or more rule definitions, each starting with a line of the form ===RULE r===.
+Return one JSON object with top-level keys equal to the rule numbers r, where each value
+is the output requested above for that rule definition only."""
+
+# Both extraction prompts are answered in one request per batch, with one combined object per rule
+COMBINED_INSTRUCTION = """Complete both tasks above for every rule definition. For each rule, return one JSON object
+with the key "technical_terms" holding the output of the technical term task (a list of terms, empty when there are none)
+and the key "measurements" holding the output of the measurement task (an empty object when there are none)."""
+
+# Definitions without a number and unit have no measurements, so only their technical terms are requested
+TERMS_INSTRUCTION = """For each rule, return one JSON object with the key "technical_terms" holding
+the extracted terms as a list (an empty list when there are none)."""
+
+# Cheap prefilters that decide which requests a definition needs: definitions that are only a
+# cross-reference (e.g. "See IN.9.2") need none, definitions without any digit need no measurements.
+# Any digit is enough, since units are written too many ways to list ("30 sec", "10 Nm", "8.1 in", ...)
+_CROSSREF_ONLY_RE = re.compile(r'\s*(?:See\s+[A-Z]+(?:\.\d+)+\.?\s*)?', re.IGNORECASE)
+_DIGIT_RE = re.compile(r'\d')
+
+# Structured outputs keyed by rule number as asked in BATCH_INSTRUCTION: {rule: {"technical_terms": [...]}} and
+# {rule: {"technical_terms": [...], "measurements": {"dimension1": {"type", "component", "value", "unit", ...}}}}
+TERMS_TEXT_FORMAT = {
+    "format": {
+        "type": "json_schema",
+        "name": "technical_terms_by_rule",
+        "strict": False,  # Rule numbers are dynamic keys, which strict schemas do not allow
+        "schema": {
+            "type": "object",
+            "additionalProperties": {
+                "type": "object",
+                "properties": {
+                    "technical_terms": {"type": "array", "items": {"type": "string"}},
+                },
+                "required": ["technical_terms"],
+                "additionalProperties": False,
+            },
+        },
+    }
+}
+DETAILS_TEXT_FORMAT = {
+    "format": {
+        "type": "json_schema",
+        "name": "details_by_rule",
+        "strict": False,  # Rule numbers and measurement labels are dynamic keys, which strict schemas do not allow
+        "schema": {
+            "type": "object",
+            "additionalProperties": {
+                "type": "object",
+                "properties": {
+                    "technical_terms": {"type": "array", "items": {"type": "string"}},
+                    "measurements": {
+                        "type": "object",
+                        "additionalProperties": {
+                            "type": "object",
+                            "properties": {
+                                "type": {"type": "string"},
+                                "component": {"anyOf": [{"type": "string"}, {"type": "array", "items": {"type": "string"}}]},
+                                "material": {"type": "string"},
+                                "welded": {"type": "string"},
+                                "criteria": {"type": "string"},
+                                "value": {"type": "string"},
+                                "unit": {"type": "string"},
+                            },
+                            "required": ["type", "component", "value", "unit"],
+                        },
+                    },
+                },
+                "required": ["technical_terms", "measurements"],
+                "additionalProperties": False,
+            },
+        },
+    }
+}
+
 
 def add_rule_numbers_to_terms(terms_dict, rule_number):
     """
@@ -25,16 +147,16 @@ def add_rule_numbers_to_terms(terms_dict, rule_number):
         dict: Transformed dictionary where each term maps to the rule number as a sub-dictionary.
               Example: {"technical_terms": {"track": "V.1.3", "center of gravity": "V.1.3", "rollover stability": "V.1.3"}}
     """
-    print(f"Adding rule number {rule_number} to terms: {terms_dict}")
+    log.debug("Adding rule number %s to terms: %s", rule_number, terms_dict)
     technical_terms = terms_dict.get("technical_terms", [])
     # Ensure technical_terms is a list
     if not isinstance(technical_terms, list):
-        print(f"Warning: technical_terms is not a list. Value: {technical_terms}")
+        log.warning("technical_terms is not a list. Value: %s", technical_terms)
         technical_terms = [] if technical_terms == "NONE" else [technical_terms]
-    print(f"Adding rule number {rule_number} to terms: {technical_terms}")
+    log.debug("Adding rule number %s to terms: %s", rule_number, technical_terms)
 
     # Transform the terms list into a dictionary with rule_number
-    transformed_terms = dict((term, rule_number) for term in technical_terms)
+    transformed_terms = {term: rule_number for term in technical_terms}
 
     return {"technical_terms": transformed_terms}
 
@@ -64,7 +186,8 @@ def add_rule_number_to_measurements(data_dict, rule_number):
     return data_dict
 
 
-def extract_details(input_file, output_file, prompt_term_extraction, prompt_measurement_extraction, start_page=1, end_page=2):
+def extract_details(input_file, output_file, prompt_term_extraction, prompt_measurement_extraction, start_page=1, end_page=2,
+                    batch_size=8, max_concurrency=20):
     """
     Reads a JSON file structured as:
     {
@@ -77,24 +200,254 @@ def extract_details(input_file, output_file, prompt_term_extraction, prompt_meas
         }
     }
     Extracts the definitions for each rule on each page.
+    Rules are sent `batch_size` at a time, each marked with a `===RULE r===` delimiter, so that
+    the long instruction prompts are paid once per batch instead of once per rule. Both prompts
+    are combined into a single request per batch, and the batches are sent concurrently, with at
+    most `max_concurrency` requests in flight. Definitions that are only a cross-reference are not
+    sent, and definitions without a number and unit are only asked for their technical terms.
+    The input file is stream-parsed one page at a time and the rules of each page are appended to
+    the JSONL output file as soon as the page is done, one {"page", "rule", "details"} record per
+    line, so only the pages in flight are held in memory. The output file is its own checkpoint:
+    a run interrupted by an API error resumes by skipping the rules it already holds.
     Args:
         json_file (str): The path to the JSON file.
+        batch_size (int, optional): Number of rule definitions sent in a single request.
+        max_concurrency (int, optional): Maximum number of concurrent requests, sized to the rate limit.
+    """
+    # Resume from the rules an interrupted run already wrote, then append the others
+    finished_rules = _load_finished_rules(output_file)
+    if finished_rules:
+        log.info("Resuming with %d rules from %s.", len(finished_rules), output_file)
+    with open(input_file, 'rb') as infile, open(output_file, 'ab') as outfile:
+        requests = _extraction_requests(prompt_term_extraction, prompt_measurement_extraction)
+        asyncio.run(_extract_details_async(infile, outfile, requests, start_page, end_page, batch_size, max_concurrency,
+                                           finished_rules))
+    log.info("Updated JSON file with technical terms saved as %s", output_file)
+
+
+def _load_finished_rules(path):
+    """
+    Reads the rules already written to the JSONL output file by an interrupted run. Lines that
+    cannot be decoded are skipped, and an incomplete last line is cut off, so that the records
+    appended next start on a line of their own.
+
+    Args:
+        path (str): Path of the JSONL output file.
+
     Returns:
-        dict: A dictionary containing page-wise extracted rule definitions as:
-        {
-            "page#": {
-                "rule#": "definition"
-            }
-        }
+        dict: Whether each (page, rule) already written has its terms extracted. Rules whose
+            extraction failed were written without terms, so they are extracted again.
     """
-    # Load the JSON file
-    with open(input_file, 'r') as file:
-        data = json.load(file)
+    finished_rules = {}
+    if not os.path.exists(path):
+        return finished_rules
+    with open(path, "r+b") as file:
+        complete_size = 0
+        for line in file:
+            if not line.endswith(b"\n"):
+                log.warning("Cutting off an incomplete line in %s", path)
+                break
+            complete_size += len(line)
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                log.warning("Skipping an undecodable line in %s", path)
+                continue
+            key = (record["page"], record["rule"])
+            # A rule retried by a resumed run is finished once any of its records has terms
+            finished_rules[key] = finished_rules.get(key, False) or "terms" in record["details"]
+        file.truncate(complete_size)
+    return finished_rules
+
+
+def _combined_prompt(prompt_term_extraction, prompt_measurement_extraction):
+    """
+    Combines the term and measurement extraction prompts into a single prompt, built once per run
+    and sent as the request instructions, ahead of the batch of definitions.
+
+    Args:
+        prompt_term_extraction (str): Prompt for the technical term extraction.
+        prompt_measurement_extraction (str): Prompt for the measurement extraction.
+
+    Returns:
+        str: One prompt asking for both outputs of every rule, see COMBINED_INSTRUCTION and BATCH_INSTRUCTION.
+    """
+    return "\n\n".join([
+        "Task 1: technical terms", prompt_term_extraction.strip(),
+        "Task 2: measurements", prompt_measurement_extraction.strip(),
+        COMBINED_INSTRUCTION, BATCH_INSTRUCTION,
+    ])
+
+
+def _extraction_requests(prompt_term_extraction, prompt_measurement_extraction):
+    """
+    Builds the prompt and structured output format of each kind of extraction request, once per run.
+
+    Args:
+        prompt_term_extraction (str): Prompt for the technical term extraction.
+        prompt_measurement_extraction (str): Prompt for the measurement extraction.
+
+    Returns:
+        dict: (prompt, text_format) for the "details" (terms and measurements) and "terms" requests.
+    """
+    return {
+        "details": (_combined_prompt(prompt_term_extraction, prompt_measurement_extraction), DETAILS_TEXT_FORMAT),
+        "terms": ("\n\n".join([prompt_term_extraction.strip(), TERMS_INSTRUCTION, BATCH_INSTRUCTION]), TERMS_TEXT_FORMAT),
+    }
+
 
-    # Prepare a dictionary to hold extracted definitions
-    extracted_definitions = {}
+def _request_kind(definition):
+    """
+    Picks the extraction request a definition needs, with the regex prefilters.
+
+    Args:
+        definition (str): The rule definition.
+
+    Returns:
+        str: "details" when it contains a digit, "terms" otherwise, or None when it is
+             empty or only a cross-reference to another rule.
+    """
+    if _CROSSREF_ONLY_RE.fullmatch(definition):
+        return None
+    if _DIGIT_RE.search(definition):
+        return "details"
+    return "terms"
+
+
+async def _extract_details_async(infile, outfile, requests, start_page, end_page, batch_size, max_concurrency,
+                                 finished_rules=None):
+    """
+    Streams the pages of `infile` to `outfile`, adding the terms and measurements of every rule in the page range.
+    At most `max_concurrency` pages are held while their requests are in flight; the oldest one is
+    written out before the next page is read. Each distinct definition is sent to the model only once
+    per run; later rules with the same definition wait for and reuse its result.
+
+    Args:
+        infile (file): Binary input file with the rules, keyed by page number and rule number.
+        outfile (file): Binary JSONL output file the updated rules are appended to.
+        requests (dict): Prompt and format of each kind of request, see `_extraction_requests`.
+        start_page (int): Starting page number for extraction.
+        end_page (int): Ending page number for extraction.
+        batch_size (int): Number of rule definitions sent in a single request.
+        max_concurrency (int): Maximum number of concurrent requests.
+        finished_rules (dict, optional): Rules already in the output file, see `_load_finished_rules`. Those
+            with their terms are not sent again, and rules outside the page range are not written twice.
+    """
+    finished_rules = finished_rules or {}
+    semaphore = asyncio.Semaphore(max_concurrency)
+    pending = deque()
+    definition_results = {}  # Definition text -> future of its extraction result, shared by all pages
+
+    # Initialize the OpenAI client (API key is automatically picked up from OPENAI_API_KEY environment variable)
+    # One pooled HTTP/2 client is shared by every request of the run
+    http_client = httpx.AsyncClient(http2=HTTP2, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    async with AsyncOpenAI(http_client=http_client) as client:
+        for page, rules in ijson.kvitems(infile, '', use_float=True):
+            rules = _decode_rules(page, rules)
+            if rules is None:
+                continue
+            # Process only pages within the specified range, each one as its own task
+            if start_page <= int(page) <= end_page:
+                rules = {rule: details for rule, details in rules.items() if not finished_rules.get((page, rule))}
+                if rules:
+                    rules = asyncio.create_task(_extract_page_details(
+                        client, semaphore, page, rules, requests, batch_size, definition_results))
+            else:
+                rules = {rule: details for rule, details in rules.items() if (page, rule) not in finished_rules}
+            pending.append((page, rules))
+            while len(pending) > max_concurrency:
+                await _write_page(outfile, *pending.popleft())
+        while pending:
+            await _write_page(outfile, *pending.popleft())
+
+
+async def _extract_page_details(client, semaphore, page, rules, requests, batch_size, definition_results):
+    """
+    Adds the terms and measurements of every rule of one page.
+
+    Args:
+        client (AsyncOpenAI): The OpenAI client.
+        semaphore (asyncio.Semaphore): Bounds the number of requests in flight.
+        page (str): The page number.
+        rules (dict or str): The rules of the page, keyed by rule number.
+        requests (dict): Prompt and format of each kind of request, see `_extraction_requests`.
+        batch_size (int): Number of rule definitions sent in a single request.
+        definition_results (dict): Futures of the extraction results by definition text, shared by all pages.
 
-    # Iterate through pages and rules
+    Returns:
+        dict: The updated rules of the page (unchanged when they could not be decoded).
+    """
+    # Step 1: Collect the rules of the page, keeping only definitions that no page has sent yet
+    page_data = {page: rules}
+    selected_rules = _select_rules(page_data, int(page), int(page))
+    loop = asyncio.get_running_loop()
+    new_rules = {kind: [] for kind in requests}
+    for _, rule, details in selected_rules:
+        definition = details.get("definition", "").strip()
+        if definition not in definition_results:
+            future = definition_results[definition] = loop.create_future()
+            kind = _request_kind(definition)
+            if kind is None:
+                future.set_result({})  # Nothing to extract
+            else:
+                new_rules[kind].append((page, rule, details))
+
+    # Step 2: Find technical terms and measurements in every batch of new definitions concurrently
+    batches = [(kind, batch) for kind, rules_of_kind in new_rules.items() for batch in _make_batches(rules_of_kind, batch_size)]
+    try:
+        responses = await asyncio.gather(
+            *(_invoke_llm_batch(client, semaphore, batch, *requests[kind]) for kind, batch in batches))
+        for (_, batch), batch_details in zip(batches, responses):
+            for page, rule, details in batch:
+                definition_results[details.get("definition", "").strip()].set_result(batch_details[(page, rule)])
+    finally:
+        # Never leave other pages waiting on a definition this page failed to extract
+        for rules_of_kind in new_rules.values():
+            for _, _, details in rules_of_kind:
+                future = definition_results[details.get("definition", "").strip()]
+                if not future.done():
+                    future.set_result(None)
+
+    # Fan every result out to all rules of the page sharing its definition
+    details_by_rule = {}
+    for page, rule, details in selected_rules:
+        details_by_rule[(page, rule)] = await definition_results[details.get("definition", "").strip()]
+
+    # Step 3: Add the rule numbers and store the terms and measurements with each rule
+    _store_details(selected_rules, details_by_rule)
+    return page_data[page]
+
+
+async def _write_page(outfile, page, rules):
+    """
+    Appends the rules of one page to the JSONL output, waiting for its extraction task first if needed.
+    The file is flushed after every page, so that an interrupted run keeps the pages it finished.
+
+    Args:
+        outfile (file): Binary JSONL output file.
+        page (str): The page number.
+        rules (dict or asyncio.Task): The rules of the page, or the task producing them.
+    """
+    if isinstance(rules, asyncio.Task):
+        rules = await rules
+    outfile.write(_rule_records(page, rules))
+    outfile.flush()
+
+
+def _select_rules(data, start_page, end_page):
+    """
+    Collects the rules of the pages within the page range. String-encoded pages are
+    decoded once and stored back in `data`, so every selected `details` aliases `data[page][rule]`.
+
+    Args:
+        data (dict): The rules, keyed by page number and rule number.
+        start_page (int): Starting page number for extraction.
+        end_page (int): Ending page number for extraction.
+
+    Returns:
+        list: List of (page, rule, details) tuples.
+    """
+    selected_rules = []
     for page, rules in data.items():
         # Extract page number from the key
         page_number = int(page)
@@ -104,68 +457,176 @@ def extract_details(input_file, output_file, prompt_term_extraction, prompt_meas
             # If rules is a string, try to parse it as JSON
             if isinstance(rules, str):
                 try:
-                    rules = json.loads(rules)
-                except json.JSONDecodeError:
-                    print(f"Warning: Could not decode rules for page {page}")
+                    data[page] = rules = orjson.loads(rules)
+                except orjson.JSONDecodeError:
+                    log.warning("Could not decode rules for page %s", page)
                     continue
-            print(f'Processing page: {page_number}, and rules: {type(rules)}')
+            log.debug("Processing page: %s, and rules: %s", page_number, type(rules))
 
             for rule, details in rules.items():
-                print(f'Processing rule: {rule} on page: {page_number}, with details: {details}')
-                # Extract the rule definition
-                definition = details.get("definition", "")
-                # Find technical terms and measurements in the definition
-                terms = invoke_llm(definition, prompt=prompt_term_extraction)
-                measurements = invoke_llm(definition, prompt=prompt_measurement_extraction)
-                # If terms is a string, convert it to a dictionary
-                if isinstance(terms, str):
-                    try:
-                        terms = json.loads(terms)
-                        measurements = json.loads(measurements)
-                    except json.JSONDecodeError:
-                        print(f"Warning: Could not decode terms for rule {rule}")
-                        continue
-                # Add the rule number to the terms dictionary
-                terms = add_rule_numbers_to_terms(terms, rule)
-                measurements = add_rule_number_to_measurements(measurements, rule)
-                #print(f"Updated terms for rule {rule}: {terms}")
-                print(f"Updated measurements for rule {rule}: {measurements}")
-                # Store the extracted definition and terms in the output dictionary
-                details["terms"] = terms["technical_terms"]
-                details["measurements"] = measurements
-                
-                if isinstance(data[page], str):
-                    try:
-                        data[page] = json.loads(data[page])
-                    except json.JSONDecodeError:
-                        print(f"Warning: Could not decode rules for page {page}")
-                data[page][rule] = details
-                #measurements = find_measurements(definition)
-                #details["measurements"] = measurements
-        #print(f"the updated JSON structure is: {data}")
-    # Save the updated JSON with terms added
-    with open(output_file, 'w') as file:
-        json.dump(data, file, indent=4)
-        print(f"Updated JSON file with technical terms saved as {output_file}")
+                selected_rules.append((page, rule, details))
+    return selected_rules
 
-    return data
 
+def _store_details(selected_rules, details_by_rule):
+    """
+    Adds the rule numbers and stores the extracted terms and measurements with each selected rule, in place.
 
-def invoke_llm(text, prompt):
+    Args:
+        selected_rules (list): List of (page, rule, details) tuples.
+        details_by_rule (dict): The combined extraction results {"technical_terms", "measurements"}, keyed by (page, rule).
+            Rules whose result is None failed to be extracted and are left without "terms" and "measurements".
+    """
+    for page, rule, details in selected_rules:
+        extracted = details_by_rule.get((page, rule), {})
+        if extracted is None:
+            continue  # Left for a later run to extract again
+        terms = {"technical_terms": extracted.get("technical_terms", [])}
+        measurements = extracted.get("measurements", {})
+        if not isinstance(measurements, dict):
+            measurements = {}
+        # Copy each entry, since rules with the same definition share one extraction result
+        measurements = {label: dict(value) for label, value in measurements.items() if isinstance(value, dict)}
+        log.debug("Processing rule: %s on page: %s, with details: %s", rule, page, details)
+        # Add the rule number to the terms dictionary
+        terms = add_rule_numbers_to_terms(terms, rule)
+        measurements = add_rule_number_to_measurements(measurements, rule)
+        #print(f"Updated terms for rule {rule}: {terms}")
+        log.debug("Updated measurements for rule %s: %s", rule, measurements)
+        # Store the extracted definition and terms in the output dictionary
+        details["terms"] = terms["technical_terms"]
+        details["measurements"] = measurements
+
+
+def _build_batch_input(batch):
+    """
+    Builds the request text for a batch of rules.
+
+    Args:
+        batch (list): List of (page, rule, details) tuples.
+
+    Returns:
+        str: The delimited rule definitions.
+    """
+    return "\n\n".join(f"{RULE_DELIMITER.format(rule=rule)}\n{details.get('definition', '').strip()}" for _, rule, details in batch)
+
+
+def _make_batches(selected_rules, batch_size):
+    """
+    Splits rules into batches of `batch_size`, shortest definitions first, so that short
+    definitions are batched together and stay on the small model.
+
+    Args:
+        selected_rules (list): List of (page, rule, details) tuples.
+        batch_size (int): Number of rule definitions sent in a single request.
+
+    Returns:
+        list: The batches, each a list of (page, rule, details) tuples.
+    """
+    ordered = sorted(selected_rules, key=lambda selected: len(selected[2].get("definition", "")))
+    return [ordered[start:start + batch_size] for start in range(0, len(ordered), batch_size)]
+
+
+def _batch_model_options(batch):
+    """
+    Picks the model and the generated token cap of a batch from the length of its definitions.
+
+    Args:
+        batch (list): List of (page, rule, details) tuples.
+
+    Returns:
+        dict: The "model" and "max_output_tokens" request arguments.
+    """
+    definition_lengths = [len(details.get("definition", "")) for _, _, details in batch]
+    model = SMALL_MODEL if max(definition_lengths) < LONG_DEFINITION_CHARS else LARGE_MODEL
+    max_output_tokens = REASONING_OUTPUT_TOKENS + OUTPUT_TOKENS_PER_RULE * len(batch) + sum(definition_lengths) // 4
+    return {"model": model, "max_output_tokens": max_output_tokens}
+
+
+async def _invoke_llm_batch(client, semaphore, batch, prompt, text_format=None):
+    """
+    Sends one batch of rule definitions to the model and splits the response back into rules.
+
+    Args:
+        client (AsyncOpenAI): The OpenAI client.
+        semaphore (asyncio.Semaphore): Bounds the number of requests in flight.
+        batch (list): List of (page, rule, details) tuples.
+        prompt (str): Instruction prompt for GPT model.
+        text_format (dict, optional): Structured output format for the response.
+
+    Returns:
+        dict: The extracted result of each rule, keyed by (page, rule), see `_split_batch_results`.
+    """
+    batch_results = await invoke_llm(client, semaphore, _build_batch_input(batch), prompt, text_format,
+                                     **_batch_model_options(batch))
+    return _split_batch_results(batch_results, batch)
+
+
+def _split_batch_results(batch_results, batch):
+    """
+    Splits the model's decoded response for a batch back into rules.
+
+    Args:
+        batch_results (dict): The decoded response, a JSON object keyed by rule number, or None when the request failed.
+        batch (list): List of (page, rule, details) tuples that were sent in the batch.
+
+    Returns:
+        dict: The extracted result of each rule, keyed by (page, rule); empty for rules missing from the
+            response, and None for every rule when the request failed.
+    """
+    if batch_results is None:
+        return {(page, rule): None for page, rule, _ in batch}
+    if not isinstance(batch_results, dict):
+        batch_results = {}
+
+    results = {}
+    for page, rule, _ in batch:
+        rule_result = batch_results.get(rule)
+        if not isinstance(rule_result, dict):
+            log.warning("No results returned for rule %s", rule)
+            rule_result = {}
+        results[(page, rule)] = rule_result
+    return results
+
+
+@lru_cache(maxsize=16)
+def _prompt_hash(model, format_name, prompt):
+    """
+    Hashes the static part of a request once per prompt; callers copy it and add the request text.
+
+    Args:
+        model (str): The model the request is sent to.
+        format_name (str): Name of the structured output format, or "".
+        prompt (str): Instruction prompt for GPT model.
+
+    Returns:
+        hashlib.blake2b: The hash of the model, format and prompt.
+    """
+    return hashlib.blake2b(f"{model}\n{format_name}\n{prompt}\n\n".encode("utf-8"))
+
+
+async def invoke_llm(client, semaphore, text, prompt, text_format=None, model=SMALL_MODEL, max_output_tokens=None,
+                     max_retries=5):
     """
     Find technical terms in the extracted definitions.
     Args:
-        extracted_definitions (dict): The extracted definitions dictionary.
+        client (AsyncOpenAI): The OpenAI client.
+        semaphore (asyncio.Semaphore): Bounds the number of requests in flight.
+        text (str): The rule definitions.
+        prompt (str): Instruction prompt for GPT model.
+        text_format (dict, optional): Structured output format, so that the response is valid JSON of that shape.
+        model (str, optional): The model to use.
+        max_output_tokens (int, optional): Cap on the generated tokens.
+        max_retries (int, optional): Number of attempts when the API rate limit is hit.
     Returns:
-        dict: A dictionary containing the found technical terms.
+        dict: A dictionary containing the found technical terms, or None when the request failed
+            or its response could not be decoded, so that it is sent again by a later run.
     """
     # If the input is a string, treat it as a single text block
     text = text.strip()
     #print(context)
 
-    # Initialize the OpenAI client (API key is automatically picked up from OPENAI_API_KEY environment variable)
-    client = OpenAI()
-    results = {}
+    results_dict = None
      # Define default prompt if none is provided
     if prompt is None:
         prompt = """You are a knowledgeable assistant specializing in technical terms and definitions.
@@ -177,88 +638,213 @@ def invoke_llm(text, prompt):
             write them in json format. {terms}: key terms separated by comma in a list
             """
 
-    # Create a chat completion
+    # The static prompt goes in the instructions, so it is not concatenated with every request's text
+    # and forms the identical prefix that the API prompt cache matches
+    options = {"model": model, "instructions": prompt, "input": text}
+    if max_output_tokens is not None:
+        options["max_output_tokens"] = max_output_tokens
+    format_name = ""
+    if text_format is not None:
+        options["text"] = text_format
+        format_name = text_format["format"]["name"]
+
+    # Reuse the response of an identical earlier request, from this run or a previous one
+    request_hash = _prompt_hash(model, format_name, prompt).copy()
+    request_hash.update(text.encode("utf-8"))
+    cache_key = request_hash.hexdigest()
+    results = _llm_cache.get(cache_key)
+
+    # Create a chat completion, backing off exponentially when rate limited
     try:
-        response = client.responses.create(
-            model="gpt-5-nano",  # Specify the model to use
-            input=prompt + "\n\n" + text,  # Combine prompt and context
-        )
+        if results is None:
+            async with semaphore:
+                while True:
+                    for attempt in range(max_retries):
+                        try:
+                            response = await client.responses.create(**options)
+                            break
+                        except RateLimitError:
+                            if attempt == max_retries - 1:
+                                raise
+                            delay = 2 ** attempt
+                            log.warning("Rate limited, retrying in %s seconds", delay)
+                            await asyncio.sleep(delay)
+                    if not is_truncated(response) or options.get("max_output_tokens", OUTPUT_TOKENS_LIMIT) >= OUTPUT_TOKENS_LIMIT:
+                        break
+                    # Cut off at the cap: the answer is incomplete JSON, so ask again with the cap doubled
+                    options["max_output_tokens"] = min(2 * options["max_output_tokens"], OUTPUT_TOKENS_LIMIT)
+                    log.warning("Results were cut off, retrying with %d output tokens", options["max_output_tokens"])
+            results = response.output_text
 
         # Access and print the model's response
-        results = response.output_text
-        print(f"Extracted results are {results}")
+        log.debug("Extracted results are %s", results)
         try:
-            results_dict = json.loads(results)
-        except json.JSONDecodeError:
-            print("Warning: Could not decode results as JSON.")
-            results_dict = {}
+            results_dict = orjson.loads(results)
+            _llm_cache[cache_key] = results  # Only responses that decode are kept
+        except orjson.JSONDecodeError:
+            log.warning("Could not decode results as JSON.")
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        log.error("An error occurred: %s", e)
 
     return results_dict
 
 
+def extract_details_batch(input_file, output_file, prompt_term_extraction, prompt_measurement_extraction, start_page=1,
+                          end_page=2, batch_size=8, batch_file='../files/extract_details_batch.jsonl', poll_interval=60):
+    """
+    Extracts the terms and measurements of each rule using the OpenAI Batch API, for long offline runs
+    over the full rulebook. Batch requests cost half as much and use a separate rate limit pool,
+    but may take up to 24 hours.
+
+    Args:
+        input_file (str): Path to the JSON file containing the extracted rules.
+        output_file (str): Path to save the rules with their terms and measurements as JSONL, see `extract_details`.
+        prompt_term_extraction (str): Prompt for the technical term extraction.
+        prompt_measurement_extraction (str): Prompt for the measurement extraction.
+        start_page (int, optional): Starting page number for extraction.
+        end_page (int, optional): Ending page number for extraction.
+        batch_size (int, optional): Number of rule definitions sent in a single request.
+        batch_file (str, optional): Path of the JSONL request file to upload.
+        poll_interval (int, optional): Seconds to wait between batch status checks.
+
+    Returns:
+        dict: The updated rules, or None when the batch did not complete.
+    """
+    # Load the JSON file
+    data = read_json(input_file)
+
+    selected_rules = _select_rules(data, start_page, end_page)
+
+    # Send each distinct definition once, on behalf of the first rule that has it
+    first_rule = {}
+    for page, rule, details in selected_rules:
+        first_rule.setdefault(details.get("definition", "").strip(), (page, rule, details))
+    requests = _extraction_requests(prompt_term_extraction, prompt_measurement_extraction)
+    unique_rules = {kind: [] for kind in requests}
+    for definition, first in first_rule.items():
+        kind = _request_kind(definition)
+        if kind is not None:
+            unique_rules[kind].append(first)
+    batches = {kind: _make_batches(rules_of_kind, batch_size) for kind, rules_of_kind in unique_rules.items()}
+
+    # Write one request per kind and batch of rules
+    with open(batch_file, "wb") as file:
+        for kind, (prompt, text_format) in requests.items():
+            for index, batch in enumerate(batches[kind]):
+                request = {
+                    "custom_id": f"{kind}-{index}",
+                    "method": "POST",
+                    "url": "/v1/responses",
+                    "body": {
+                        "instructions": prompt,
+                        "input": _build_batch_input(batch),
+                        "text": text_format,
+                        **_batch_model_options(batch),
+                    },
+                }
+                file.write(orjson.dumps(request) + b"\n")
+
+    # Initialize the OpenAI client (API key is automatically picked up from OPENAI_API_KEY environment variable)
+    client = OpenAI(http_client=httpx.Client(http2=HTTP2, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT))
+    with open(batch_file, "rb") as file:
+        batch_input_file = client.files.create(file=file, purpose="batch")
+    batch_job = client.batches.create(input_file_id=batch_input_file.id, endpoint="/v1/responses", completion_window="24h")
+    log.info("Submitted batch %s with %d requests.", batch_job.id, sum(map(len, batches.values())))
+
+    # Poll until the batch reaches a final state
+    while batch_job.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch_job = client.batches.retrieve(batch_job.id)
+        log.info("Batch %s status: %s", batch_job.id, batch_job.status)
+
+    if batch_job.status != "completed" or batch_job.output_file_id is None:
+        log.info("Batch %s finished with status %s; no results were saved.", batch_job.id, batch_job.status)
+        return None
+
+    # Map each output line back to its rules through the custom_id; rules of requests missing from the output failed
+    results = {(page, rule): None for batches_of_kind in batches.values() for batch in batches_of_kind for page, rule, _ in batch}
+    output = client.files.content(batch_job.output_file_id).text
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        kind, index = record["custom_id"].rsplit("-", 1)
+        batch = batches[kind][int(index)]
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            log.error("An error occurred for rules %s: %s", [rule for _, rule, _ in batch],
+                      record.get('error') or response)
+            batch_results = None
+        else:
+            try:
+                batch_results = orjson.loads(response_output_text(response["body"]))
+            except orjson.JSONDecodeError:
+                log.warning("Could not decode results as JSON.")
+                batch_results = None
+        results.update(_split_batch_results(batch_results, batch))
+
+    # Fan every result out to all rules sharing its definition
+    details_by_rule = {}
+    for page, rule, details in selected_rules:
+        first_page, first_rule_number, _ = first_rule[details.get("definition", "").strip()]
+        details_by_rule[(page, rule)] = results.get((first_page, first_rule_number), {})
+    _store_details(selected_rules, details_by_rule)
+
+    # Save the updated rules with terms added as JSONL, the intermediate format read by the next step
+    with open(output_file, 'wb') as file:
+        for page, rules in data.items():
+            rules = _decode_rules(page, rules)
+            if rules is None:
+                continue
+            file.write(_rule_records(page, rules))
+    log.info("Updated JSON file with technical terms saved as %s", output_file)
+
+    return data
+
 
 def extract_term_as_key(input_file, output_file):
     """
-    Processes a JSON structure to concatenate rule numbers for each term across all pages,
-    and add a summary structure to the JSON file.
+    Processes the JSONL records written by `extract_details` to concatenate rule numbers for each term
+    across all pages, and writes the rules as JSON with a summary structure under a single "_summary" key.
 
     Args:
-        input_file (str): Path to the input JSON file.
+        input_file (str): Path to the input JSONL file.
         output_file (str): Path where the processed JSON will be written.
     """
-    # Read the JSON file
-    with open(input_file, 'r') as file:
-        data = json.load(file)
+    data = {}
 
     # Initialize dictionary to hold term-wise concatenated structure
-    concatenated_terms = defaultdict(lambda: {"pages": set(), "rules": set()})
-    
-    # Iterate through pages and rules to build the concatenated term dictionary
-    for page, page_data in data.items():
-        if isinstance(page_data, str):
-            try:
-                page_data = json.loads(page_data)
-            except json.JSONDecodeError:
-                print(f"Warning: Could not decode page data for page {page}")
-                continue
-            print(f'Processing page: {page}, and rules: {type(page_data)}')
-        for key, rule_data in page_data.items():
-            page_number = rule_data.get("page#", page)
-            rule_number = rule_data.get("rule#", "")
-            definition = rule_data.get("definition", "")
-            terms = rule_data.get("terms", {})
-
-            for term, rule in terms.items():
-                concatenated_terms[term]["pages"].add(page_number)
-                concatenated_terms[term]["rules"].add(rule_number)
-                concatenated_terms[term]["definition"] = definition  # Overwrite with latest definition
-
-    # Convert sets to lists for JSON serialization immediately after population
-    for term in concatenated_terms:
-        concatenated_terms[term]["pages"] = list(concatenated_terms[term]["pages"])
-        concatenated_terms[term]["rules"] = list(concatenated_terms[term]["rules"])
-
-    # Add the concatenated term structure back to the original data under a new key
-    summary = {
-        page: {
-            term: {
-                "page#": term_data["pages"],
-                "rule#": term_data["rules"],
-                "definition": term_data["definition"],
-                "terms": {term: term_data["rules"]}  # Nested structure
-            }
-            for term, term_data in concatenated_terms.items()
+    concatenated_terms = {}
+
+    # Stream the records once, rebuilding the pages and the concatenated term dictionary together
+    for page, key, rule_data in read_records(input_file):
+        data.setdefault(page, {})[key] = rule_data  # A rule written again by a resumed run replaces the earlier record
+        page_number = rule_data.get("page#", page)
+        rule_number = rule_data.get("rule#", "")
+        definition = rule_data.get("definition", "")
+        terms = rule_data.get("terms", {})
+
+        for term in terms:
+            term_data = concatenated_terms.setdefault(term, {"pages": set(), "rules": set(), "definition": ""})
+            term_data["pages"].add(page_number)
+            term_data["rules"].add(rule_number)
+            term_data["definition"] = definition  # Overwrite with latest definition
+
+    # Add the concatenated term structure to the original data under one key, with each set converted to a list once
+    summary = {}
+    for term, term_data in concatenated_terms.items():
+        rules = sorted(term_data["rules"], key=str)
+        summary[term] = {
+            "page#": sorted(term_data["pages"], key=str),
+            "rule#": rules,
+            "definition": term_data["definition"],
+            "terms": {term: rules}  # Nested structure
         }
-        for page in data.keys()
-    }
-    data.update(summary)
+    data["_summary"] = summary
 
     # Write the updated JSON to a new file
-    with open(output_file, 'w') as file:
-        json.dump(data, file, indent=4)
+    write_json(output_file, data)
 
 
 prompt_term_extraction = """
@@ -495,20 +1081,25 @@ Include all components and contextual details associated with the numerical valu
 Ensure the output adheres strictly to the JSON format examples for consistency.
 
 """
-input_file = '../files/extracted_rules.json'
-output_file = '../files/processed_rules.json'
-output_file_with_terms = '../files/processed_rules_with_terms.json'
-
-# Define the start and end page numbers for extraction
-start_page = 19  # Starting page number
-end_page = 19  #len(page_content_dict)   # Ending page number
-extract_details(
-    input_file=input_file,
-    output_file=output_file,
-    prompt_term_extraction=prompt_term_extraction,
-    prompt_measurement_extraction=prompt_measurement_extraction,
-    start_page=start_page,
-    end_page=end_page   
-)
-
-#process_json(output_file, output_file_with_terms)
+if __name__ == "__main__":
+    # Guarded so that the helpers can be imported, e.g. by the tests, without re-running the script
+    input_file = '../files/extracted_rules.json'
+    output_file = '../files/processed_rules.jsonl'
+    output_file_with_terms = '../files/processed_rules_with_terms.json'
+
+    # Set LOGLEVEL=DEBUG to see per-rule progress
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"), format="%(message)s")
+
+    # Define the start and end page numbers for extraction
+    start_page = 19  # Starting page number
+    end_page = 19  #len(page_content_dict)   # Ending page number
+    extract_details(
+        input_file=input_file,
+        output_file=output_file,
+        prompt_term_extraction=prompt_term_extraction,
+        prompt_measurement_extraction=prompt_measurement_extraction,
+        start_page=start_page,
+        end_page=end_page   
+    )
+
+    #process_json(output_file, output_file_with_terms)
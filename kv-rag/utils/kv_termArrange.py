@@ -3,13 +3,36 @@ import json
 import sys
 from dotenv import load_dotenv
 from openai import OpenAI
-from collections import defaultdict
+import pandas as pd
+from kv_common import load_rules, read_json, read_records, write_json
 
 
-# Load .env from the parent directory (adjust path if needed)
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '../../.env'))
+# Load .env from the parent directory (adjust path if needed), unless the key is already in the environment
+if "OPENAI_API_KEY" not in os.environ:
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '../../.env'))
 #api_key = os.getenv("OPENAI_API_KEY")    
 
+def _decode_pages(data):
+    """
+    Decodes string-encoded page entries (as returned by the LLM) in place, so that every
+    value of `data` is a dictionary. Pages that cannot be decoded are dropped.
+
+    Args:
+        data (dict): Dictionary structured as {page#: {rule#: {...}}} or {page#: "json string"}.
+
+    Returns:
+        dict: The same dictionary with all values decoded.
+    """
+    for page, rules in list(data.items()):
+        if isinstance(rules, str):
+            try:
+                data[page] = json.loads(rules)
+            except json.JSONDecodeError:
+                print(f"Warning: Could not decode rules for page {page}")
+                del data[page]
+    return data
+
+
 def flatten_json(input_file, output_file):
     """
     Reads a JSON file with structure {page#: {rule#: {page#, rule#, definition:}}}
@@ -20,110 +43,84 @@ def flatten_json(input_file, output_file):
         output_file (str): Path to the output JSON file to save the flattened structure.
     """
     # Step 1: Load the input JSON file
-    with open(input_file, 'r') as file:
-        data = json.load(file)
+    data = _decode_pages(read_json(input_file))
 
     # Step 2: Initialize the flattened structure
     flattened_data = {}
 
     # Step 3: Iterate through the nested structure to flatten it
     for page, rules in data.items():
-        if isinstance(rules, str):
-            try:
-                rules = json.loads(rules)
-            except json.JSONDecodeError:
-                print(f"Warning: Could not decode rules for page {page}")
-                continue
         for rule, details in rules.items():
             # Add the rule to the flattened structure
             flattened_data[rule] = details
 
     # Step 4: Write the flattened JSON structure to the output
-    with open(output_file, 'w') as file:
-        json.dump(flattened_data, file, indent=4)
-        print(f"Flattened JSON file saved as {output_file}")
+    write_json(output_file, flattened_data)
+    print(f"Flattened JSON file saved as {output_file}")
 
 
 def extract_terms(input_file, output_file):
     """
-    This function takes a JSON file as input, processes it to:
+    This function takes the JSONL file of rule records as input, processes it to:
     1. Concatenate terms across all pages and keys.
     2. Update rule# and page# into lists where terms are present on multiple pages/keys.
     3. Flatten page# structure since each key is unique.
     4. Add an entry for each term as a key to the JSON structure and write to a new JSON file.
 
     Arguments:
-        input_file (str): Path to the input JSON file.
+        input_file (str): Path to the input JSONL file.
         output_file (str): Path where the processed JSON will be written.
     """
-    # Step 1: Read the input JSON file
-    with open(input_file, 'r') as file:
-        data = json.load(file)
-
-    # Step 2: Initialize default dictionary to concatenate terms
-    concatenated_terms = defaultdict(lambda: {
-        "page_number": set(),
-        "rule_number": set(),
-        "definition": "",
-        "terms": "",
-        "measurements": ""
-    })
-
-    # Step 3: Iterate through pages and keys to concatenate terms
-    for page, keys in data.items():
-        #print(f'Processing page: {page}, and rules: {keys}')
-        if isinstance(keys, str):
-            try:
-                keys = json.loads(keys)
-            except json.JSONDecodeError:
-                print(f"Warning: Could not decode page data for page {page}")
-                continue
-            
-        for key, key_data in keys.items():
-            page_number = key_data.get("page_number", page)  # Default to current page
-            rule_number = key_data.get("rule_number", key)  # Default to key
-            terms = key_data.get("terms", {})
-            definition = key_data.get("definition", "")
-
-            # Process each term
-            for term, term_rule in terms.items():
-                concatenated_terms[term]["page_number"].add(page_number)  # Collect all unique pages
-                concatenated_terms[term]["rule_number"].add(term_rule)    # Collect all unique rules
-                if not concatenated_terms[term]["definition"]:      # Add definition if it doesn't exist
-                    concatenated_terms[term]["definition"] = definition
-                concatenated_terms[term]["terms"] = term  # Add the raw term name
-
-    # Step 4: Convert `page#` and `rule#` sets to lists for serialization
-    for term in concatenated_terms:
-        concatenated_terms[term]["page_number"] = list(concatenated_terms[term]["page_number"])
-        concatenated_terms[term]["rule_number"] = list(concatenated_terms[term]["rule_number"])
-
-    # Step 5: Modify the original JSON to flatten the structure
+    # Step 1: Stream the records of the input JSONL file once, flattening the structure and
+    # every term occurrence into a (term, page_number, rule_number, definition) row together
+    rows = []
     flattened_data = {}
-    for page, keys in data.items():
-        if isinstance(keys, str):
-            try:
-                keys = json.loads(keys)
-            except json.JSONDecodeError:
-                print(f"Warning: Could not decode page data for page {page}")
-                continue
-            print(f'Processing page: {page}, and rules: {type(keys)}')
-
-        for key, value in keys.items():
-            # Get rid of nested `page#` and restructure
-            flattened_data[key] = {
-                "rule_number": value.get("rule_number", ""),
-                "definition": value.get("definition", ""),
-                "terms": value.get("terms", {}),
-                "measurements": {}
+    memo = {}  # Share one string object per distinct term, page and rule value
+    for page, key, key_data in read_records(input_file):
+        # Get rid of nested `page#` and restructure; a rule written again by a resumed run replaces the earlier record
+        flattened_data[key] = {
+            "rule_number": key_data.get("rule_number", ""),
+            "definition": key_data.get("definition", ""),
+            "terms": key_data.get("terms", {}),
+            "measurements": {}
+        }
+
+        page_number = key_data.get("page_number", page)  # Default to current page
+        page_number = memo.setdefault(page_number, page_number)
+        terms = key_data.get("terms", {})
+        # Empty definitions become None so that groupby 'first' skips them
+        definition = key_data.get("definition", "") or None
+
+        for term, term_rule in terms.items():
+            term = memo.setdefault(term, term)
+            term_rule = memo.setdefault(term_rule, term_rule)
+            rows.append((term, page_number, term_rule, definition))
+
+    # Step 2: Concatenate terms in one groupby pass, keeping terms in order of first appearance
+    concatenated_terms = {}
+    if rows:
+        df = pd.DataFrame(rows, columns=["term", "page", "rule", "definition"])
+        grouped = df.groupby("term", sort=False).agg(
+            page_number=("page", "unique"),    # Collect all unique pages
+            rule_number=("rule", "unique"),    # Collect all unique rules
+            definition=("definition", "first"),  # First non-empty definition
+        )
+
+        # Step 3: Convert the unique arrays to lists for serialization
+        for term, term_data in grouped.to_dict(orient="index").items():
+            concatenated_terms[term] = {
+                "page_number": term_data["page_number"].tolist(),
+                "rule_number": term_data["rule_number"].tolist(),
+                "definition": term_data["definition"] if isinstance(term_data["definition"], str) else "",
+                "terms": term,  # Add the raw term name
+                "measurements": ""
             }
 
-    # Step 6: Add concatenated terms as new entries
+    # Step 4: Add concatenated terms as new entries
     flattened_data.update(concatenated_terms)
 
-    # Step 7: Write the modified data to a new JSON file
-    with open(output_file, 'w') as file:
-        json.dump(flattened_data, file, indent=4)
+    # Step 5: Write the modified data to a new JSON file
+    write_json(output_file, flattened_data)
 
 
 def extract_information(input_file, key_to_extract, information_to_extract):
@@ -140,9 +137,8 @@ def extract_information(input_file, key_to_extract, information_to_extract):
     Returns:
         str or list: The extracted information, or a message if the key is not found or invalid.
     """
-    # Step 1: Load the JSON file
-    with open(input_file, 'r') as file:
-        data = json.load(file)
+    # Step 1: Load the JSON file (cached until the file changes on disk)
+    data, term_index = load_rules(input_file, os.path.getmtime(input_file))
 
     # Step 2: Extract definition for a rule number
     if information_to_extract == "definition":
@@ -159,34 +155,15 @@ def extract_information(input_file, key_to_extract, information_to_extract):
         
     # Step 3: Extract rule numbers for a technical term
     elif information_to_extract == "rule_numbers":
-        # Check if the key_to_extract matches any term across the JSON
-        rule_numbers = []
-        for key, value in data.items():
-            if isinstance(value, str):
-                try:
-                    value = json.loads(value)
-                except json.JSONDecodeError:
-                    print(f"Warning: Could not decode data for key {key}")
-                    continue
-                print(f'Processing key: {key}, and value: {type(value)}')
-            terms = value.get("terms", {})
-            if isinstance(terms, str):
-                try:
-                    terms = json.loads(terms)
-                except json.JSONDecodeError:
-                    print(f"Warning: Could not decode terms for key {key}")
-                    continue
-            print(f'Processing key: {key}, and terms: {type(terms)}')
-            for term, rule in terms.items():
-                if term.lower() == key_to_extract.lower():  # Case-insensitive matching
-                    rule_numbers.append(rule)
+        # Look the term up in the precomputed index (case-insensitive matching)
+        rule_numbers = list(term_index.get(key_to_extract.lower(), []))
         return rule_numbers if rule_numbers else f"Technical term '{key_to_extract}' not found in the JSON file."
 
     # Step 4: Handle invalid information_to_extract values
     else:
         return f"Invalid information_to_extract value: {information_to_extract}. Use 'definition' or 'rule_numbers'."
     
-output_file = '../files/processed_rules.json'
+output_file = '../files/processed_rules.jsonl'
 output_file_with_terms = '../files/processed_rules_with_terms.json'
 
 extract_terms(output_file, output_file_with_terms)